@@ -0,0 +1,221 @@
+'''
+Offline benchmarks for the HRUD hot paths.
+
+Synthetic Lima sized fixtures (HDX population points, H3 grids at resolutions 8-10 and
+facility sets) are generated locally, so no network calls are made. Every method is
+timed and memory profiled at several sizes and the results are saved as JSON so
+successive versions can be compared.
+
+Usage
+-----
+
+    python benchmarks/bench_hrud.py --output bench_results.json
+    python benchmarks/bench_hrud.py --output new.json --compare bench_results.json
+
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hrud import HRUD
+
+# Approximate extent of Lima Metropolitana
+LIMA_BOUNDS = (-77.20, -12.52, -76.62, -11.57)
+
+# Scale factors applied to the full Lima sizes
+SIZES = {'small': 0.1, 'medium': 0.5, 'full': 1.0}
+FULL_POINTS = 350000
+FULL_FACILITIES = 5000
+MIN_SECONDS = 0.05
+
+
+def lima_polygon():
+    '''
+    Synthetic city polygon: an irregular ellipse covering the Lima extent.
+    '''
+
+    minx, miny, maxx, maxy = LIMA_BOUNDS
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    radius = 1 - 0.15 * np.sin(3 * angles)
+    x = (minx + maxx) / 2 + (maxx - minx) / 2 * radius * np.cos(angles)
+    y = (miny + maxy) / 2 + (maxy - miny) / 2 * radius * np.sin(angles)
+
+    return gpd.GeoDataFrame(geometry=[Polygon(zip(x, y))], crs='EPSG:4326')
+
+
+def hdx_points(n, seed=0):
+    '''
+    Synthetic HDX population DataFrame with n points over the Lima extent.
+    '''
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = LIMA_BOUNDS
+    return pd.DataFrame({
+        'latitude': rng.uniform(miny, maxy, n),
+        'longitude': rng.uniform(minx, maxx, n),
+        'population_2015': rng.gamma(2, 5, n),
+        'population_2020': rng.gamma(2, 5, n),
+    })
+
+
+def measure(func, repeat):
+    '''
+    Best wall time over repeat runs, then peak traced memory in a separate run so
+    tracing does not affect the timings.
+    '''
+
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'peak_mb': peak / 1024 ** 2}
+
+
+def run(sizes, resolutions, repeat):
+    hrud = HRUD()
+    city = lima_polygon()
+    results = list()
+
+    def record(name, size, params, func):
+        result = {'benchmark': name, 'size': size, **params, **measure(func, repeat)}
+        print(f"{name:<24} {size:<7} {json.dumps(params):<40} {result['seconds']:8.3f}s {result['peak_mb']:9.1f}MB")
+        results.append(result)
+
+    for size in sizes:
+        scale = SIZES[size]
+        n_points = int(FULL_POINTS * scale)
+        n_facilities = int(FULL_FACILITIES * scale)
+
+        pop = hdx_points(n_points)
+        points = hrud.filter_population(pop, city)
+        facilities = hdx_points(n_facilities, seed=1)
+
+        record('filter_population', size, {'points': n_points},
+               lambda: hrud.filter_population(pop, city))
+        record('filter_population_exact', size, {'points': n_points},
+               lambda: hrud.filter_population(pop, city, exact=True))
+
+        tree = np.radians(facilities[['latitude', 'longitude']].values)
+        query = np.radians(pop[['latitude', 'longitude']].values)
+        record('nn_search', size, {'facilities': n_facilities, 'points': n_points},
+               lambda: hrud.nn_search(tree, query))
+
+        for resolution in resolutions:
+            # Grid sizes depend on the resolution only, so they are benchmarked once
+            if size == sizes[0]:
+                record('gen_hexagons', 'city', {'resolution': resolution},
+                       lambda: hrud.gen_hexagons(resolution, city))
+
+            hexagons, _ = hrud.gen_hexagons(resolution, city)
+            agg = {'population_2020': 'sum'}
+            params = {'resolution': resolution, 'points': n_points}
+
+            record('merge_shape_hex_sjoin', size, params,
+                   lambda: hrud.merge_shape_hex(hexagons, points, 'inner', 'within', agg))
+            record('merge_shape_hex_h3', size, params,
+                   lambda: hrud.merge_shape_hex(hexagons, points, 'inner', 'within', agg, method='h3'))
+
+            if size == sizes[0]:
+                hex_pop = hrud.merge_shape_hex(hexagons, points, 'inner', 'within', agg, method='h3')
+                bins = [0, 50, 100, 200, 500, 1000, np.inf]
+                for layer_type in ('PolygonLayer', 'H3HexagonLayer'):
+                    record(f'pydeck_df_{layer_type}', 'city', {'resolution': resolution},
+                           lambda: hrud.pydeck_df(hex_pop, ['population_2020'], 'magma', bins,
+                                                  'population_2020', layer_type=layer_type))
+
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'geopandas': gpd.__version__,
+    }
+
+
+def compare(results, baseline_path, threshold):
+    '''
+    Print time and memory ratios against a previous run and return the regressions.
+    '''
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    key = lambda result: json.dumps({k: v for k, v in result.items() if k not in ('seconds', 'peak_mb')},
+                                    sort_keys=True)
+    previous = {key(result): result for result in baseline['results']}
+
+    regressions = list()
+    print(f'\nComparison against {baseline_path} ({baseline["metadata"].get("commit")})')
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        time_ratio = result['seconds'] / old['seconds'] if old['seconds'] else np.inf
+        memory_ratio = result['peak_mb'] / old['peak_mb'] if old['peak_mb'] else np.inf
+        # Timings of a few milliseconds are too noisy to compare
+        slower = time_ratio > threshold and result['seconds'] > MIN_SECONDS
+        flag = 'REGRESSION' if slower or memory_ratio > threshold else ''
+        print(f"{result['benchmark']:<24} {result['size']:<7} time x{time_ratio:5.2f}  memory x{memory_ratio:5.2f}  {flag}")
+        if flag:
+            regressions.append(result)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the HRUD hot paths')
+    parser.add_argument('--sizes', default='small,medium,full',
+                        help=f'Comma separated sizes from {list(SIZES)}')
+    parser.add_argument('--resolutions', default='8,9,10', help='Comma separated H3 resolutions')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark')
+    parser.add_argument('--output', default='bench_results.json', help='Output JSON file')
+    parser.add_argument('--compare', default=None, help='Previous results JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Time or memory ratio flagged as regression')
+    args = parser.parse_args(argv)
+
+    warnings.filterwarnings('ignore')
+    results = run(args.sizes.split(','), [int(r) for r in args.resolutions.split(',')], args.repeat)
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': metadata(), 'results': results}, f, indent=2)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+'''
+Load test for the hexagon indicator service (hrud.service).
+
+Concurrent keep-alive clients send a mix of district requests at several resolutions to
+a running service and the p50/p99 latency and throughput are reported, together with the
+cache counters from /stats. Repeated districts are served from the LRU cache, so the
+share of unique requests sets the hit rate.
+
+Usage
+-----
+
+    python -m hrud.service config.json --port 8080 &
+    python benchmarks/load_test.py --port 8080 --districts MIRAFLORES,LINCE,SURCO \\
+        --resolutions 7,8,9 --concurrency 16 --requests 500
+
+'''
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlencode
+import numpy as np
+
+
+async def request(reader, writer, host, path):
+    '''
+    Send a GET request on an open connection and return the status and body.
+    '''
+
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, paths, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while paths:
+            path = paths.pop()
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, path)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(host, port, districts, resolutions, concurrency, total, seed):
+    rng = random.Random(seed)
+    paths = [f'/indicators?{urlencode({"district": rng.choice(districts), "resolution": rng.choice(resolutions)})}'
+             for _ in range(total)]
+
+    latencies, errors = list(), list()
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, paths, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await request(reader, writer, host, '/stats')
+    writer.close()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        'max_ms': round(float(latencies.max()), 2),
+        'stats': json.loads(body),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the hexagon indicator service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--districts', required=True, help='Comma separated district names')
+    parser.add_argument('--resolutions', default='9', help='Comma separated resolutions')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent connections')
+    parser.add_argument('--requests', type=int, default=500, help='Total number of requests')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args.host, args.port, args.districts.split(','),
+                             [int(res) for res in args.resolutions.split(',')],
+                             args.concurrency, args.requests, args.seed))
+    print(json.dumps(result, indent=2))
+
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,13 @@
 from .hrud import HRUD
+from .cache import HRUDCache
+from .facility_index import FacilityIndex
+from .accessibility import Accessibility
+from .location import FacilityLocation
+from .routing import OSRMClient
+from .pyramid import HexPyramid
+from .hexgrid import HexGrid
+from .mask import PolygonMask
+from .service import HexService
+from .instrumentation import Instrumentation, JSONLogSink, MetricsRegistry
 
 hrud_test = HRUD()
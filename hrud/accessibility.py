@@ -0,0 +1,218 @@
+import numpy as np
+from scipy import sparse
+from .facility_index import FacilityIndex
+
+
+class Accessibility(object):
+    '''
+    Accessibility scores between hexagons and facilities (markets, clinics) from a sparse
+    cost matrix. Only the pairs within the catchment are stored, so both steps of the
+    floating catchment and the gravity sums are sparse matrix products.
+
+    Parameters
+    ----------
+
+    rows: array_like
+          Hexagon position of every pair
+
+    cols: array_like
+          Facility position of every pair
+
+    costs: array_like
+           Travel cost of every pair (km from from_index, or the unit of the travel table)
+
+    shape: tuple
+           (number of hexagons, number of facilities)
+
+    max_cost: float, optional
+              Catchment size, used as bandwidth of the gaussian decay
+
+    Example
+    -------
+
+    >> markets = download_overpass_poi(lima.total_bounds, 'food_supply')
+    >> access = Accessibility.from_index(FacilityIndex.from_gdf(markets), lima_centroids, radius=1.5)
+    >> lima_hex['2sfca'], markets['ratio'] = access.two_step_fca(lima_hex['population_2020'])
+    >> lima_hex['gravity'] = access.gravity(decay='exponential', beta=1.0)
+
+    '''
+
+    def __init__(self, rows, cols, costs, shape, max_cost=None):
+        self.costs = sparse.csr_matrix((np.asarray(costs, dtype=np.float64), (rows, cols)), shape=shape)
+        self.max_cost = max_cost
+
+    @classmethod
+    def from_index(cls, index, lat, lon=None, radius=1.0, n_jobs=1):
+        '''
+        Build the cost matrix from the facilities within a radius of every hexagon.
+
+        Parameters
+        ----------
+
+        index: FacilityIndex or GeoDataFrame
+               Facility index, or a facility point GeoDataFrame to index
+
+        lat, lon: hexagon centroids, see FacilityIndex.query
+
+        radius: float
+                Catchment radius in km
+
+        n_jobs: int
+                Number of threads for the radius queries
+        '''
+
+        if not isinstance(index, FacilityIndex):
+            index = FacilityIndex.from_gdf(index)
+
+        distances, indices = index.query_radius(lat, lon, radius=radius, n_jobs=n_jobs)
+        counts = np.fromiter((len(neighbors) for neighbors in indices), dtype=np.int64, count=len(indices))
+
+        rows = np.repeat(np.arange(len(indices)), counts)
+        cols = np.concatenate(indices) if len(indices) else np.array([], dtype=np.int64)
+        costs = np.concatenate(distances) if len(distances) else np.array([])
+
+        return cls(rows, cols, costs, (len(indices), index.n_facilities), max_cost=radius)
+
+    @classmethod
+    def from_table(cls, table, max_cost):
+        '''
+        Build the cost matrix from a travel cost table (e.g. the durations from
+        OSRMClient.table), keeping the pairs up to max_cost. Missing routes (NaN) are dropped.
+
+        Parameters
+        ----------
+
+        table: array_like (n_hexagons, n_facilities)
+
+        max_cost: float
+                  Catchment size in the unit of the table
+        '''
+
+        table = np.asarray(table, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            rows, cols = np.nonzero(table <= max_cost)
+
+        return cls(rows, cols, table[rows, cols], table.shape, max_cost=max_cost)
+
+    @property
+    def shape(self):
+        return self.costs.shape
+
+    def weights(self, decay='binary', beta=1.0, min_cost=0.1):
+        '''
+        Sparse matrix of distance decay weights with the structure of the cost matrix.
+
+        Parameters
+        ----------
+
+        decay: str. One of {'binary', 'exponential', 'power', 'gaussian'}
+               'binary': 1 inside the catchment
+               'exponential': exp(-beta * cost)
+               'power': max(cost, min_cost) ** -beta
+               'gaussian': exp(-0.5 * (cost / max_cost) ** 2), as in the enhanced 2SFCA
+
+        beta: float
+              Decay parameter
+
+        min_cost: float
+                  Lower bound of the cost in the power decay, so a facility on top of a
+                  centroid does not get an infinite weight
+        '''
+
+        costs = self.costs.data
+        if decay == 'binary':
+            values = np.ones_like(costs)
+        elif decay == 'exponential':
+            values = np.exp(-beta * costs)
+        elif decay == 'power':
+            values = np.maximum(costs, min_cost) ** -beta
+        elif decay == 'gaussian':
+            if self.max_cost is None:
+                raise ValueError('The gaussian decay needs max_cost')
+            values = np.exp(-0.5 * (costs / self.max_cost) ** 2)
+        else:
+            raise ValueError(f'Unknown decay {decay!r}')
+
+        # Same sparsity structure as costs: zero costs keep their entry
+        return sparse.csr_matrix((values, self.costs.indices, self.costs.indptr), shape=self.shape)
+
+    def two_step_fca(self, population, supply=None, decay='binary', **kwargs):
+        '''
+        Two step floating catchment area.
+
+        Step 1: supply to demand ratio of every facility, R_j = S_j / sum_i P_i W_ij
+        Step 2: accessibility of every hexagon, A_i = sum_j W_ij R_j
+
+        Parameters
+        ----------
+
+        population: array_like
+                    Demand of every hexagon (e.g. population_2020 from merge_shape_hex)
+
+        supply: array_like, optional
+                Capacity of every facility (e.g. from market_capacity). Default 1 per facility
+
+        decay: see weights. 'binary' is the original 2SFCA, 'gaussian' the enhanced 2SFCA
+
+        kwargs: passed to weights
+
+        Returns
+        -------
+
+        access: ndarray
+                Accessibility of every hexagon, in supply per person
+
+        ratio: ndarray
+               Supply to demand ratio of every facility. 0 when there is no demand in its catchment
+        '''
+
+        weights = self.weights(decay, **kwargs)
+        population = np.nan_to_num(np.asarray(population, dtype=np.float64))
+        supply = self._supply(supply)
+
+        demand = weights.T @ population
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(demand > 0, supply / demand, 0.0)
+
+        return weights @ ratio, ratio
+
+    def gravity(self, supply=None, decay='power', population=None, **kwargs):
+        '''
+        Gravity accessibility. Without population this is the Hansen potential
+        A_i = sum_j S_j f(c_ij). With population the supply is adjusted by the demand
+        competing for every facility, A_i = sum_j S_j f(c_ij) / sum_k P_k f(c_kj).
+
+        Parameters
+        ----------
+
+        supply: array_like, optional
+                Attractiveness or capacity of every facility. Default 1 per facility
+
+        decay: see weights
+
+        population: array_like, optional
+                    Demand of every hexagon
+
+        kwargs: passed to weights
+
+        Returns
+        -------
+
+        access: ndarray
+                Accessibility of every hexagon
+        '''
+
+        weights = self.weights(decay, **kwargs)
+        supply = self._supply(supply)
+
+        if population is not None:
+            demand = weights.T @ np.nan_to_num(np.asarray(population, dtype=np.float64))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                supply = np.where(demand > 0, supply / demand, 0.0)
+
+        return weights @ supply
+
+    def _supply(self, supply):
+        if supply is None:
+            return np.ones(self.shape[1])
+        return np.nan_to_num(np.asarray(supply, dtype=np.float64))
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+import geopandas as gpd
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError: # Windows: the index is still replaced atomically, without the lock
+    fcntl = None
+
+
+class HRUDCache(object):
+    '''
+    Persistent on-disk cache for the HRUD downloads. Every entry is stored as one or
+    more Parquet/GeoParquet files, keyed on a hash of the query parameters.
+
+    Parameters
+    ----------
+
+    cache_dir: str
+               Directory where the cache files and index are stored
+
+    ttl: float, optional
+         Time to live of an entry in seconds. Expired entries are treated as misses.
+         None keeps entries forever.
+
+    max_size: int, optional
+              Maximum total size of the cache in bytes. Least recently used entries are
+              evicted once the limit is exceeded. None disables eviction.
+
+    offline: bool
+             If True, never call the network: misses raise LookupError.
+
+    The index is updated under a file lock and replaced atomically, so several processes
+    (e.g. the pipeline workers) can share a cache_dir.
+
+    Example
+    -------
+
+    >> cache = HRUDCache('cache', ttl=7*24*3600, max_size=2*1024**3)
+    >> lima = cache.get_or_fetch(('osm', 'Lima, Peru'), lambda: download(...))
+    >> cache.stats
+    {'hits': 0, 'misses': 1}
+
+    '''
+
+    def __init__(self, cache_dir, ttl=None, max_size=None, offline=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.stats = {'hits': 0, 'misses': 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+
+    def key(self, params):
+        '''
+        Util function to hash the query parameters into a cache key.
+        '''
+
+        return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_or_fetch(self, params, fetch):
+        '''
+        Return the cached value for params, calling fetch on a miss.
+
+        Parameters
+        ----------
+
+        params: tuple
+                Query parameters identifying the entry (query, bounds, est_type, resource id)
+
+        fetch: callable
+               Function without arguments returning a DataFrame, a GeoDataFrame or a tuple
+               of them
+
+        Returns
+        -------
+
+        value: DataFrame, GeoDataFrame or tuple
+               Cached or freshly fetched value
+
+        '''
+
+        key = self.key(params)
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry['created'] > self.ttl:
+                self._remove(key, index)
+                entry = None
+            if entry is not None:
+                entry['accessed'] = time.time()
+
+        if entry is not None:
+            try:
+                value = self._load(key, entry)
+                self.stats['hits'] += 1
+                return value
+            except FileNotFoundError: # Evicted by another process after the index was read
+                pass
+
+        self.stats['misses'] += 1
+        if self.offline:
+            raise LookupError(f'{params} is not cached and offline mode is enabled')
+
+        value = fetch()
+        self._store(key, value)
+
+        return value
+
+    def report(self):
+        '''
+        Summary of the cache usage for the current session.
+
+        Returns
+        -------
+
+        report: dict
+                hits, misses, number of entries and total size in bytes
+        '''
+
+        index = self._read_index()
+        return {**self.stats,
+                'entries': len(index),
+                'size': sum(entry['size'] for entry in index.values())}
+
+    def _store(self, key, value):
+        frames = value if isinstance(value, tuple) else (value,)
+        paths = list()
+        json_columns = list()
+
+        for i, frame in enumerate(frames):
+            path = os.path.join(self.cache_dir, f'{key}_{i}.parquet')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            frame, columns = self._encode(frame)
+            frame.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+            paths.append(path)
+            json_columns.append(columns)
+
+        now = time.time()
+        entry = {
+            'paths': paths,
+            'json_columns': json_columns,
+            'is_tuple': isinstance(value, tuple),
+            'created': now,
+            'accessed': now,
+            'size': sum(os.path.getsize(path) for path in paths),
+        }
+        with self._locked_index() as index:
+            index[key] = entry
+            self._evict(index)
+
+    def _load(self, key, entry):
+        frames = list()
+        for path, columns in zip(entry['paths'], entry['json_columns']):
+            try:
+                frame = gpd.read_parquet(path)
+            except ValueError: # Not a GeoParquet file
+                frame = pd.read_parquet(path)
+            for column in columns:
+                frame[column] = frame[column].apply(lambda value: None if value is None else json.loads(value))
+            frames.append(frame)
+
+        return tuple(frames) if entry['is_tuple'] else frames[0]
+
+    def _encode(self, frame):
+        '''
+        Nested values (dicts and lists, e.g. OSM tags) are stored as JSON strings.
+        '''
+
+        frame = frame.copy()
+        json_columns = list()
+        geometry = frame.geometry.name if isinstance(frame, gpd.GeoDataFrame) else None
+
+        frame.columns = frame.columns.astype(str)
+        for column in frame.columns:
+            if column == geometry or frame[column].dtype != object:
+                continue
+            if frame[column].map(lambda value: isinstance(value, (dict, list))).any():
+                frame[column] = frame[column].map(lambda value: value if _is_missing(value) else json.dumps(value))
+                json_columns.append(column)
+
+        return frame, json_columns
+
+    def _evict(self, index):
+        if self.max_size is None:
+            return
+
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]['accessed']):
+            if total <= self.max_size:
+                break
+            total -= index[key]['size']
+            self._remove(key, index)
+
+    def _remove(self, key, index):
+        for path in index.pop(key)['paths']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @contextmanager
+    def _locked_index(self):
+        '''
+        Util function to read, modify and write the index while holding the cache lock.
+        '''
+
+        with open(os.path.join(self.cache_dir, 'index.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return dict()
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def _is_missing(value):
+    return not isinstance(value, (dict, list)) and pd.isna(value)
@@ -0,0 +1,175 @@
+import os
+import pickle
+import numpy as np
+from sklearn.neighbors import BallTree
+from concurrent.futures import ThreadPoolExecutor
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class FacilityIndex(object):
+    '''
+    Nearest neighbor index over a set of facilities (markets, clinics, parks). The
+    BallTree is built once and reused for every query, and can be saved to disk.
+
+    Parameters
+    ----------
+
+    lat: array_like
+         Facility latitudes
+
+    lon: array_like
+         Facility longitudes
+
+    degrees: bool
+             Flag in case coordinates are in degrees and need to be converted to radians.
+             Default True.
+
+    leaf_size: int
+               BallTree leaf size
+
+    Example
+    -------
+
+    >> markets_index = FacilityIndex.from_gdf(sjl_old_markets)
+    >> distances, indices = markets_index.query(sjl_hexs_centroids, k=3)
+    >> markets_index.save('outputs/sjl_markets.idx')
+
+    '''
+
+    def __init__(self, lat, lon, degrees=True, leaf_size=40):
+        self.degrees = degrees
+        coords = self._to_radians(lat, lon)
+        self.n_facilities = coords.shape[0]
+        self.tree = BallTree(coords, leaf_size=leaf_size, metric='haversine')
+
+    @classmethod
+    def from_gdf(cls, gdf, **kwargs):
+        '''
+        Build an index from a point GeoDataFrame in EPSG 4326.
+        '''
+
+        return cls(gdf.geometry.y.values, gdf.geometry.x.values, **kwargs)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load an index saved with save.
+        '''
+
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        '''
+        Save the index to disk.
+        '''
+
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def query(self, lat, lon=None, k=1, n_jobs=1):
+        '''
+        k nearest facilities for every query point.
+
+        Parameters
+        ----------
+
+        lat: array_like or GeoDataFrame
+             Query latitudes, or a point GeoDataFrame (e.g. hexagon centroids from gen_hexagons)
+
+        lon: array_like
+             Query longitudes. Not needed when lat is a GeoDataFrame
+
+        k: int
+           Number of neighbors
+
+        n_jobs: int
+                Number of threads the query array is split across (not processes). -1 uses
+                one thread per CPU; the speedup depends on BallTree releasing the GIL.
+
+        Returns
+        -------
+
+        distances: ndarray (n, k)
+                   Haversine distance in km to each neighbor
+
+        indices: ndarray (n, k)
+                 Positional index of each neighbor in the facility set
+
+        '''
+
+        coords = self._query_coords(lat, lon)
+        results = self._map(lambda chunk: self.tree.query(chunk, k=k), coords, n_jobs)
+
+        distances = np.concatenate([result[0] for result in results]) * EARTH_RADIUS_KM
+        indices = np.concatenate([result[1] for result in results])
+
+        return distances, indices
+
+    def query_radius(self, lat, lon=None, radius=1.0, n_jobs=1, sort_results=False):
+        '''
+        Facilities within a radius of every query point.
+
+        Parameters
+        ----------
+
+        lat, lon: see query
+
+        radius: float
+                Search radius in km
+
+        n_jobs: int
+                Number of threads the query array is split across (not processes). -1 uses
+                one thread per CPU; the speedup depends on BallTree releasing the GIL.
+
+        sort_results: bool
+                      Sort neighbors of every point by distance
+
+        Returns
+        -------
+
+        distances: ndarray of arrays
+                   Haversine distance in km to the facilities within the radius of each point
+
+        indices: ndarray of arrays
+                 Positional index of the facilities within the radius of each point
+
+        '''
+
+        coords = self._query_coords(lat, lon)
+        r = radius / EARTH_RADIUS_KM
+        results = self._map(lambda chunk: self.tree.query_radius(chunk, r=r, return_distance=True,
+                                                                 sort_results=sort_results),
+                            coords, n_jobs)
+
+        indices = np.concatenate([result[0] for result in results])
+        distances = np.concatenate([result[1] for result in results])
+        for i in range(len(distances)):
+            distances[i] = distances[i] * EARTH_RADIUS_KM
+
+        return distances, indices
+
+    def _to_radians(self, lat, lon):
+        coords = np.column_stack([np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)])
+        return np.radians(coords) if self.degrees else coords
+
+    def _query_coords(self, lat, lon):
+        if lon is None:
+            return self._to_radians(lat.geometry.y.values, lat.geometry.x.values)
+        return self._to_radians(lat, lon)
+
+    def _map(self, func, coords, n_jobs):
+        '''
+        Split the query array across threads. BallTree queries release the GIL.
+        '''
+
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+
+        if n_jobs <= 1 or len(coords) < 2 * n_jobs:
+            return [func(coords)]
+
+        chunks = np.array_split(coords, n_jobs)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(func, chunks))
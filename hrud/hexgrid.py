@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from .hrud import h3_vect, _h3_to_int, _int_to_h3, _hex_geometries, _aggregate_points
+
+
+class HexGrid(object):
+    '''
+    Compact H3 grid. Indexes are stored as a sorted uint64 array and indicators as typed
+    NumPy arrays, so joins are done on integer keys and no geometry is held in memory.
+    Geometries are only built when converting to a GeoDataFrame.
+
+    Parameters
+    ----------
+
+    h3_indexes: array_like
+                uint64 H3 indexes. Duplicates are dropped
+
+    resolution: int, optional
+                H3 resolution. Inferred from the indexes if not provided
+
+    columns: dict, optional
+             Indicator arrays aligned with h3_indexes
+
+    Example
+    -------
+
+    >> lima_hex, lima_centroids = gen_hexagons(9, lima)
+    >> grid = HexGrid.from_gdf(lima_hex)
+    >> grid.aggregate_points(pop_lima, {'population_2020': 'sum'})
+    >> grid['population_2020'][:3]
+    array([ 83.12, 0., 1204.55], dtype=float32)
+    >> lima_hex = grid.to_gdf()
+
+    '''
+
+    __slots__ = ('h3', 'resolution', 'columns')
+
+    def __init__(self, h3_indexes, resolution=None, columns=None):
+        h3_indexes = np.asarray(h3_indexes, dtype=np.uint64)
+        h3_indexes, order = np.unique(h3_indexes, return_index=True)
+
+        self.h3 = h3_indexes
+        self.resolution = resolution
+        if resolution is None and len(h3_indexes):
+            self.resolution = int(h3_vect.h3_get_resolution(h3_indexes[:1])[0])
+
+        self.columns = dict()
+        for name, values in (columns or {}).items():
+            self.columns[name] = np.asarray(values)[order]
+
+    @classmethod
+    def from_gdf(cls, gdf, hex_col=0, columns=None, dtype=None):
+        '''
+        Build a grid from a gen_hexagons or merge_shape_hex GeoDataFrame.
+
+        Parameters
+        ----------
+
+        gdf: GeoDataFrame
+             Hexagon GeoDataFrame with the H3 hex strings in hex_col
+
+        hex_col: column name containing the H3 indexes
+
+        columns: list, optional
+                 Indicator columns to keep. Default all non geometry columns
+
+        dtype: numpy dtype, optional
+               Cast indicator columns to this dtype (e.g. np.float32)
+        '''
+
+        if columns is None:
+            columns = [column for column in gdf.columns if column not in (hex_col, gdf.geometry.name)]
+
+        data = dict()
+        for column in columns:
+            values = gdf[column].values
+            data[column] = values.astype(dtype) if dtype is not None else values
+
+        return cls(_h3_to_int(gdf[hex_col].values), columns=data)
+
+    def __len__(self):
+        return len(self.h3)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        if len(values) != len(self.h3):
+            raise ValueError(f'Column {name} has {len(values)} values for {len(self.h3)} hexagons')
+        self.columns[name] = values
+
+    @property
+    def nbytes(self):
+        '''
+        Memory used by the indexes and indicator arrays, in bytes.
+        '''
+
+        return self.h3.nbytes + sum(values.nbytes for values in self.columns.values())
+
+    def lookup(self, h3_indexes):
+        '''
+        Position of each uint64 H3 index in the grid, -1 if it is not in the grid.
+        '''
+
+        h3_indexes = np.asarray(h3_indexes, dtype=np.uint64)
+        if len(self.h3) == 0:
+            return np.full(len(h3_indexes), -1)
+
+        positions = np.searchsorted(self.h3, h3_indexes)
+        positions = np.minimum(positions, len(self.h3) - 1)
+        found = self.h3[positions] == h3_indexes
+
+        return np.where(found, positions, -1)
+
+    def join(self, other, columns=None, fill_value=np.nan):
+        '''
+        Add columns from another grid or from a DataFrame indexed by uint64 H3 index,
+        joining on the integer keys.
+
+        Parameters
+        ----------
+
+        other: HexGrid or DataFrame
+
+        columns: list, optional
+                 Columns to join. Default all
+
+        fill_value: value for hexagons without a match
+        '''
+
+        if isinstance(other, HexGrid):
+            keys, data = other.h3, other.columns
+        else:
+            keys, data = other.index.values, {column: other[column].values for column in other.columns}
+
+        columns = list(data.keys()) if columns is None else columns
+        positions = pd.Index(np.asarray(keys, dtype=np.uint64)).get_indexer(self.h3)
+        matched = positions >= 0
+
+        for column in columns:
+            values = np.asarray(data[column])
+            dtype = np.result_type(values.dtype, np.min_scalar_type(fill_value)) if values.dtype.kind in 'iuf' else object
+            joined = np.full(len(self.h3), fill_value, dtype=dtype)
+            joined[matched] = values[positions[matched]]
+            self.columns[column] = joined
+
+        return self
+
+    def aggregate_points(self, points, agg, dtype=np.float32):
+        '''
+        Aggregate point data into the grid by H3 index, as merge_shape_hex method='h3'.
+
+        Parameters
+        ----------
+
+        points: GeoDataFrame
+                Point GeoDataFrame in EPSG 4326 (e.g. from filter_population)
+
+        agg: dict. Column names as keys and one of {'sum', 'min', 'max', 'count'} as values
+
+        dtype: numpy dtype of the aggregated columns
+        '''
+
+        return self.join(_aggregate_points(points, self.resolution, agg, dtype))
+
+    def to_gdf(self, centroids=False, hex_col=0):
+        '''
+        Convert the grid to the gen_hexagons GeoDataFrame format (hex_id, indicators, geom).
+
+        Parameters
+        ----------
+
+        centroids: bool
+                   Return hexagon centroids instead of polygons
+
+        hex_col: name of the column for the H3 hex strings
+        '''
+
+        h3_indexes = _int_to_h3(self.h3)
+        polygons, points = _hex_geometries(h3_indexes)
+
+        frame = pd.DataFrame({hex_col: h3_indexes})
+        for name, values in self.columns.items():
+            frame[name] = values
+
+        return gpd.GeoDataFrame(frame, geometry=points if centroids else polygons, crs='EPSG:4326')
@@ -1,21 +1,180 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import warnings
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import requests
 import matplotlib.pyplot as plt
 import pydeck as pdk
+import shapely
 from h3 import h3
 from sklearn.neighbors import BallTree
-from shapely.geometry import Point, Polygon
+from shapely.geometry import box
 from math import radians
-from numba import jit
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .cache import HRUDCache
+from .instrumentation import Instrumentation, instrument_public_methods
+from .facility_index import FacilityIndex, EARTH_RADIUS_KM
+from .mask import PolygonMask
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore') # h3.unstable warns on import
+    from h3.unstable import vect as h3_vect
 
-# - Generar métricas de acceso
 # - Generar mapas y visualizaciones con los resultados
 
+# Número de índices de nn_search guardados en el objeto HRUD
+NN_INDEX_CACHE_SIZE = 8
+
+# Número estimado de hexágonos desde el cual el polyfill se reparte en procesos
+POLYFILL_PARALLEL_MIN_HEXAGONS = 1000000
+
+def _polyfill(geojson, resolution):
+    '''
+    Util function to polyfill a single polygon. Defined at module level so it can
+    be sent to worker processes.
+    '''
+
+    return list(h3.polyfill(geojson, res=resolution, geo_json_conformant=True))
+
+def _split_polygon(polygon, n_strips):
+    '''
+    Util function to split a polygon into vertical strips of equal width. Every hexagon
+    centroid falls inside exactly one strip, so the union of the strips' polyfills is
+    the polyfill of the whole polygon.
+    '''
+
+    if n_strips <= 1:
+        return [polygon]
+
+    minx, miny, maxx, maxy = polygon.bounds
+    edges = np.linspace(minx, maxx, n_strips + 1)
+    strips = [polygon.intersection(box(x0, miny, x1, maxy)) for x0, x1 in zip(edges[:-1], edges[1:])]
+
+    parts = list()
+    for strip in strips:
+        if strip.is_empty:
+            continue
+        parts.extend(getattr(strip, 'geoms', [strip]))
+
+    return [part for part in parts if part.geom_type == 'Polygon']
+
+def _hex_geometries(h3_indexes):
+    '''
+    Util function to build hexagon polygons and centroids for an array of H3 indexes.
+    Coordinates are gathered into NumPy arrays and converted to geometries in one call.
+
+    Returns
+    -------
+
+    polygons: ndarray
+              Hexagon polygons (lon, lat)
+    centroids: ndarray
+               Hexagon centroids (lon, lat)
+    '''
+
+    n = len(h3_indexes)
+
+    # Boundaries have 6 vertices, 5 for pentagons and up to 10 for cells crossing icosahedron edges
+    boundaries = [h3.h3_to_geo_boundary(hexagon, geo_json=True) for hexagon in h3_indexes] # format as x,y (lon, lat)
+    sizes = np.fromiter((len(boundary) for boundary in boundaries), dtype=np.int64, count=n)
+    coords = np.array([vertex for boundary in boundaries for vertex in boundary], dtype=np.float64).reshape(-1, 2)
+
+    latlon = np.array([h3.h3_to_geo(hexagon) for hexagon in h3_indexes], dtype=np.float64).reshape(n, 2)
+
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=np.repeat(np.arange(n), sizes)))
+    centroids = shapely.points(latlon[:, 1], latlon[:, 0])
+
+    return polygons, centroids
+
+def _aggregate_points(points, resolution, agg, dtype=None):
+    '''
+    Util function to aggregate a point GeoDataFrame by H3 index. Points are indexed in
+    bulk at the resolution and aggregated with a groupby on the uint64 index. Shared by
+    merge_shape_hex method='h3', HexGrid.aggregate_points and HexPyramid.from_points.
+
+    Returns
+    -------
+
+    aggregated: DataFrame
+                agg columns indexed by uint64 H3 index, cast to dtype if given. NaN values
+                are skipped, so cells with only NaN sum to 0
+    '''
+
+    lat = np.ascontiguousarray(points.geometry.y.values, dtype=np.float64)
+    lon = np.ascontiguousarray(points.geometry.x.values, dtype=np.float64)
+    cells = h3_vect.geo_to_h3(lat, lon, resolution)
+
+    frame = pd.DataFrame(points[list(agg.keys())].values, columns=list(agg.keys()))
+    aggregated = frame.infer_objects().groupby(cells, sort=False).agg(agg)
+
+    return aggregated if dtype is None else aggregated.astype(dtype)
+
+_get_lon = itemgetter('lon')
+_get_lat = itemgetter('lat')
+
+def _h3_to_int(h3_indexes):
+    '''
+    Util function to convert an array of H3 hex strings to uint64 integers.
+    '''
+
+    return np.fromiter((int(hexagon, 16) for hexagon in h3_indexes), dtype=np.uint64, count=len(h3_indexes))
+
+def _int_to_h3(h3_ints):
+    '''
+    Util function to convert an array of uint64 H3 indexes to hex strings.
+    '''
+
+    return np.array([format(int(hexagon), 'x') for hexagon in h3_ints], dtype=object)
+
+def _intersection_areas(source_geoms, hex_geoms):
+    '''
+    Util function to compute the intersection areas of aligned arrays of geometries.
+    Defined at module level so it can be sent to worker processes.
+    '''
+
+    return shapely.area(shapely.intersection(source_geoms, hex_geoms))
+
+# Códigos de sufijo de zona del INEI (ZONA_A) usados en los shapefiles (SUFZONA)
+ZONA_A_TO_SUFZONA = {'A': '01', 'B': '02', 'C': '03', 'D': '04', 'E': '05', 'F': '06', 'G': '07', 'H': '08'}
+
+# Columnas de identificación y nombres de los CSV del censo 2017
+INEI_CODE_COLUMNS = ['UBIGEO', 'CCDD', 'DPTO', 'CCPP', 'PROVINCIA', 'CCDI', 'DISTRITO',
+                     'CODCCPP', 'NOMCCPP', 'ZONA_ID', 'ZONA_A', 'MANZANA_ID', 'MANZANA_A']
+
+@instrument_public_methods
 class HRUD(object):
+    '''
+    Parameters
+    ----------
+
+    cache_dir: str, optional
+               Directory for the persistent download cache. If None, downloads are not cached.
+
+    cache_ttl: float, optional
+               Time to live of cached downloads in seconds.
+
+    cache_max_size: int, optional
+                    Maximum size of the cache in bytes, enforced with LRU eviction.
+
+    offline: bool
+             Serve downloads only from the cache, without network calls.
+
+    Every public method can be instrumented with per call metrics, see instrument.
+    '''
+
+    def __init__(self, cache_dir=None, cache_ttl=None, cache_max_size=None, offline=False):
+        self.instrumentation = None
+        self.cache = None
+        self._nn_indexes = dict()
+        if cache_dir is not None:
+            self.cache = HRUDCache(cache_dir, ttl=cache_ttl, max_size=cache_max_size, offline=offline)
 
-    def __init__(self):
         self.hdx_url = 'https://data.humdata.org/dataset/{}'
         self.overpass_url = "http://overpass-api.de/api/interpreter"
         self.osm_url = 'https://nominatim.openstreetmap.org/search.php'
@@ -56,13 +215,68 @@ class HRUD(object):
         '''
         self.osm_parameters['q'] = query
 
-        response = requests.get(self.osm_url, params=self.osm_parameters)
-        all_results = response.json()
-        gdf = gpd.GeoDataFrame.from_features(all_results['features'])
+        def fetch():
+            response = requests.get(self.osm_url, params=self.osm_parameters)
+            self._count_bytes(len(response.content))
+            all_results = response.json()
+            return gpd.GeoDataFrame.from_features(all_results['features'])
+
+        gdf = self._cached(('osm', query), fetch)
         city = gdf.iloc[expected_position:expected_position+1, :]
 
         return city
 
+    def instrument(self, sinks=None, track_memory=True):
+        '''
+        Enable per call metrics on every public method: wall time, peak memory, input and
+        output row counts and network bytes. Call with sinks=None to disable them.
+
+        Parameters
+        ----------
+
+        sinks: list
+               Record sinks, e.g. [JSONLogSink(), MetricsRegistry()]
+
+        track_memory: bool
+                      Measure peak memory with tracemalloc
+
+        Returns
+        -------
+
+        instrumentation: Instrumentation or None
+                         Can also be used as hrud.instrumentation.stage(name) to record
+                         custom blocks of code
+
+        Example
+        -------
+
+        >> registry = MetricsRegistry()
+        >> hrud.instrument([registry])
+        >> hex, centroids = hrud.gen_hexagons(9, lima)
+        >> print(registry.exposition())
+
+        '''
+
+        self.instrumentation = None if sinks is None else Instrumentation(sinks, track_memory)
+        return self.instrumentation
+
+    def _count_bytes(self, nbytes):
+        '''
+        Util function to add downloaded bytes to the instrumentation record.
+        '''
+
+        if self.instrumentation is not None:
+            self.instrumentation.add_network_bytes(nbytes)
+
+    def _cached(self, params, fetch):
+        '''
+        Util function to serve a download from the cache when it is enabled.
+        '''
+
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(params, fetch)
+
     def merge_geom_downloads(self, gdfs):
         '''
         Merge several GeoDataFrames from OSM download_osm
@@ -129,10 +343,10 @@ class HRUD(object):
 
         '''
 
-        population = pd.read_csv(self.hdx_url.format(resource))
+        population = self._cached(('hdx', resource), lambda: pd.read_csv(self.hdx_url.format(resource)))
         return population
 
-    def filter_population(self, pop_df, polygon_gdf):
+    def filter_population(self, pop_df, polygon_gdf, exclude=None, exact=False):
         '''
         Filter an HDX database download to the polygon bounds
 
@@ -145,6 +359,13 @@ class HRUD(object):
         polygon_gdf: GeoDataFrame
                      Result from download_osm or merge_geom_downloads
 
+        exclude: GeoDataFrame or list of geometries, optional
+                 Polygons to remove (e.g. islands). Implies exact
+
+        exact: bool
+               Keep only the points inside the polygons instead of their bounds, with
+               a PolygonMask
+
         Returns
         -------
 
@@ -166,15 +387,205 @@ class HRUD(object):
 
         '''
 
+        if exact or exclude is not None:
+            filtered_points = pop_df[PolygonMask(polygon_gdf, exclude=exclude).contains(pop_df)]
+        else:
+            minx, miny, maxx, maxy = polygon_gdf.geometry.total_bounds
+            limits_filter = pop_df['longitude'].between(minx, maxx) & pop_df['latitude'].between(miny, maxy)
+            filtered_points = pop_df[limits_filter]
+
+        geometry_ = gpd.points_from_xy(filtered_points['longitude'], filtered_points['latitude'])
+        filtered_points_gdf = gpd.GeoDataFrame(filtered_points, geometry=geometry_, crs='EPSG:4326')
+
+        return filtered_points_gdf
+
+    def stream_hdx(self, resource, polygon_gdf, chunksize=500000, cache_path=None):
+        '''
+        Download the High Resolution Population Density maps from HDX in chunks, keeping
+        only the points inside the polygon. Peak memory scales with the filtered output
+        instead of the national file.
+
+        Parameters
+        ----------
+
+        resource: str
+                  Specific address to the resource for each city. See download_hdx
+
+        polygon_gdf: GeoDataFrame
+                     Result from download_osm or merge_geom_downloads
+
+        chunksize: int
+                   Number of CSV rows read per chunk
+
+        cache_path: str, optional
+                    If provided, the filtered points are also written to this path as
+                    GeoParquet
+
+        Returns
+        -------
+
+        filtered_points_gdf: GeoDataFrame
+                             Population points inside the polygon, with float32 columns
+
+        Example
+        -------
+
+        >> lima = download_osm(2, "Lima, Peru")
+        >> pop_lima = stream_hdx("4e74db39-87f1-4383-9255-eaf8ebceb0c9/resource/317f1c39-8417-4bde-a076-99bd37feefce/download/population_per_2018-10-01.csv.zip", lima)
+        >> pop_lima.dtypes
+        latitude           float32
+        longitude          float32
+        population_2015    float32
+        population_2020    float32
+        geometry          geometry
+
+        '''
+
         minx, miny, maxx, maxy = polygon_gdf.geometry.total_bounds
-        limits_filter = pop_df['longitude'].between(minx, maxx) & pop_df['latitude'].between(miny, maxy)
-        filtered_points = pop_df[limits_filter]
+        polygon = polygon_gdf.geometry.unary_union
+        shapely.prepare(polygon)
+
+        reader = pd.read_csv(self.hdx_url.format(resource), chunksize=chunksize,
+                             dtype=np.float32)
+
+        filtered_chunks = list()
+        for chunk in reader:
+            lon = chunk['longitude'].values
+            lat = chunk['latitude'].values
+
+            # Cheap bbox filter first, exact point in polygon only on the remaining rows
+            limits_filter = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+            chunk = chunk[limits_filter]
+            inside = shapely.contains_xy(polygon, chunk['longitude'].values, chunk['latitude'].values)
+            filtered_chunks.append(chunk[inside])
+
+        filtered_points = pd.concat(filtered_chunks, ignore_index=True)
 
         geometry_ = gpd.points_from_xy(filtered_points['longitude'], filtered_points['latitude'])
         filtered_points_gdf = gpd.GeoDataFrame(filtered_points, geometry=geometry_, crs='EPSG:4326')
 
+        if cache_path is not None:
+            filtered_points_gdf.to_parquet(cache_path)
+
         return filtered_points_gdf
 
+    def read_population_raster(self, path, polygon_gdf, resolution, hex=None, column='population',
+                               band=1, block_rows=1024, hex_col=0):
+        '''
+        Aggregate the GeoTIFF form of the High Resolution Population Density maps into H3
+        cells. Only the window covering the polygon bounds is read, in blocks of rows, and
+        non empty pixels go straight to H3 sums without building a point GeoDataFrame.
+
+        Requires rasterio (pip install rasterio).
+
+        Parameters
+        ----------
+
+        path: str
+              GeoTIFF path or URL in EPSG 4326, e.g. population_per_2018-10-01.tif
+
+        polygon_gdf: GeoDataFrame
+                     Result from download_osm or merge_geom_downloads. Pixels whose center
+                     is outside the polygon are dropped
+
+        resolution: int
+                    H3 resolution
+
+        hex: GeoDataFrame, optional
+             Result from gen_hexagons. If provided, the sums are merged into it as in
+             merge_shape_hex
+
+        column: str
+                Name of the population column
+
+        band: int
+              Raster band with the population
+
+        block_rows: int
+                    Number of raster rows read at a time
+
+        hex_col: column name in hex containing the H3 indexes
+
+        Returns
+        -------
+
+        population: HexGrid or GeoDataFrame
+                    HexGrid with the population of every non empty cell, or a copy of hex
+                    with the population column when hex is provided
+
+        Example
+        -------
+
+        >> lima = download_osm(2, 'Lima, Peru')
+        >> lima_hex, _ = gen_hexagons(9, lima)
+        >> read_population_raster('population_per_2018-10-01.tif', lima, 9, hex=lima_hex,
+                                  column='population_2020')
+
+        0               | geometry                                          | population_2020
+        898e62c8003ffff | POLYGON ((-77.04312 -12.04118, -77.04409 -12.0... | 412.338
+        898e62c8007ffff | POLYGON ((-77.04181 -12.04449, -77.04279 -12.0... | 398.014
+
+        '''
+
+        try:
+            import rasterio
+            from rasterio.windows import Window, from_bounds
+        except ImportError as err:
+            raise ImportError('read_population_raster requires rasterio: pip install rasterio') from err
+
+        from .hexgrid import HexGrid # hexgrid imports the H3 helpers from this module
+
+        polygon = polygon_gdf.geometry.unary_union
+        shapely.prepare(polygon)
+
+        cells = list()
+        sums = list()
+        with rasterio.open(path) as src:
+            window = from_bounds(*polygon_gdf.geometry.total_bounds, transform=src.transform)
+
+            # Whole pixels covering the bounds, clipped to the raster
+            col_start = max(int(np.floor(window.col_off)), 0)
+            row_start = max(int(np.floor(window.row_off)), 0)
+            col_end = min(int(np.ceil(window.col_off + window.width)), src.width)
+            row_end = min(int(np.ceil(window.row_off + window.height)), src.height)
+
+            for row_off in range(row_start, row_end, block_rows):
+                block = Window(col_start, row_off, max(col_end - col_start, 0), min(block_rows, row_end - row_off))
+                values = src.read(band, window=block)
+
+                valid = np.isfinite(values) & (values > 0)
+                if src.nodata is not None:
+                    valid &= values != src.nodata
+                rows, cols = np.nonzero(valid)
+                if len(rows) == 0:
+                    continue
+
+                # Pixel centers
+                lon, lat = src.window_transform(block) * (cols + 0.5, rows + 0.5)
+                inside = shapely.contains_xy(polygon, lon, lat)
+
+                block_cells = h3_vect.geo_to_h3(np.ascontiguousarray(lat[inside]),
+                                                np.ascontiguousarray(lon[inside]), resolution)
+                block_cells, inverse = np.unique(block_cells, return_inverse=True)
+                cells.append(block_cells)
+                sums.append(np.bincount(inverse, weights=values[rows[inside], cols[inside]]))
+
+        cells = np.concatenate(cells) if cells else np.array([], dtype=np.uint64)
+        sums = np.concatenate(sums) if sums else np.array([])
+
+        # Las celdas pueden repetirse entre bloques
+        cells, inverse = np.unique(cells, return_inverse=True)
+        grid = HexGrid(cells, resolution=resolution, columns={column: np.bincount(inverse, weights=sums)})
+
+        if hex is None:
+            return grid
+
+        ret_hex = hex.copy()
+        positions = grid.lookup(_h3_to_int(hex[hex_col].values))
+        ret_hex[column] = np.where(positions >= 0, grid[column][positions], np.nan)
+
+        return ret_hex
+
     def remove_features(self, gdf, bounds):
         '''
         Remove a set of features based on bounds
@@ -186,7 +597,9 @@ class HRUD(object):
              Input GeoDataFrame containing the point features filtered with filter_population
 
         bounds: array_like
-                Array input following [miny, maxy, minx, maxx] for filtering
+                Array input following [miny, maxy, minx, maxx] for filtering, or a list
+                of them to remove several areas in a single pass. Points on the edges of
+                the rectangles are removed in both cases
 
 
         Returns
@@ -202,11 +615,16 @@ class HRUD(object):
         >> print(lima.shape, removed.shape)
         (348434, 4) (348427, 4)
         '''
-        miny, maxy, minx, maxx = bounds
-        filter = gdf['latitude'].between(miny,maxy) & gdf['longitude'].between(minx,maxx)
-        drop_ix = gdf[filter].index
+        if np.ndim(bounds) == 1:
+            miny, maxy, minx, maxx = bounds
+            filter = gdf['latitude'].between(miny,maxy) & gdf['longitude'].between(minx,maxx)
+            return gdf[~filter.values]
+
+        # Los bordes se eliminan, igual que con un solo rectángulo
+        boxes = [box(minx, miny, maxx, maxy) for miny, maxy, minx, maxx in bounds]
+        inside = PolygonMask(boxes, include_edges=True).contains(gdf['latitude'].values, gdf['longitude'].values)
 
-        return gdf.drop(drop_ix)
+        return gdf[~inside]
 
     def download_overpass_poi(self, bounds, est_type):
         '''
@@ -237,10 +655,111 @@ class HRUD(object):
         minx, miny, maxx, maxy = bounds
 
         bbox_string = f'{minx},{miny},{maxx},{maxy}'
+        overpass_query = self._overpass_query(est_type)
 
-        # Definir consulta para instalaciones de oferta de alimentos en Lima
-        overpass_url = "http://overpass-api.de/api/interpreter"
+        def fetch():
+            # Request data
+            response = requests.get(self.overpass_url, params={'data': overpass_query,
+                                                               'bbox': bbox_string})
+            self._count_bytes(len(response.content))
+            data = response.json()
+            return self._parse_overpass(data['elements'], est_type)
+
+        return self._cached(('overpass', [float(b) for b in bounds], est_type), fetch)
+
+    def download_overpass_poi_tiled(self, bounds, est_type, n_tiles=(4, 4), max_workers=4,
+                                    retries=3, backoff=1.0, timeout=180):
+        '''
+        Download POIs using Overpass API, splitting the bounds into a grid of tiles that are
+        requested concurrently. Failed tiles are retried with exponential backoff without
+        requesting the other tiles again, and elements returned by several tiles (e.g. ways
+        crossing tile borders) are deduplicated on their OSM id.
+
+        Parameters
+        ----------
+
+        bounds: array_like
+                Input bounds for query. Follows [minx,miny,maxx,maxy] pattern.
+
+        est_type: {'food_supply', 'healthcare_facilities', 'parks_pitches'}
+                  Type of establishment to download. See download_overpass_poi
+
+        n_tiles: tuple
+                 Number of tiles along x and y
+
+        max_workers: int
+                     Maximum number of concurrent requests
+
+        retries: int
+                 Number of retries for each failed tile
+
+        backoff: float
+                 Seconds to wait before the first retry. Doubles on every retry.
 
+        timeout: float
+                 Timeout in seconds for each request
+
+        Returns
+        -------
+
+        Same output as download_overpass_poi
+
+        Example
+        -------
+
+        >> lima = download_osm(2, "Lima, Peru")
+        >> markets = download_overpass_poi_tiled(lima.total_bounds, 'food_supply', n_tiles=(3, 5))
+
+        '''
+        minx, miny, maxx, maxy = bounds
+        overpass_query = self._overpass_query(est_type)
+
+        xs = np.linspace(minx, maxx, n_tiles[0] + 1)
+        ys = np.linspace(miny, maxy, n_tiles[1] + 1)
+        bbox_strings = [f'{x0},{y0},{x1},{y1}' for x0, x1 in zip(xs[:-1], xs[1:])
+                                              for y0, y1 in zip(ys[:-1], ys[1:])]
+
+        def fetch_tile(session, bbox_string):
+            for attempt in range(retries + 1):
+                try:
+                    response = session.get(self.overpass_url, params={'data': overpass_query,
+                                                                      'bbox': bbox_string},
+                                           timeout=timeout)
+                    response.raise_for_status()
+                    return response.json()['elements'], len(response.content)
+                except (requests.RequestException, ValueError):
+                    if attempt == retries:
+                        raise
+                    time.sleep(backoff * 2 ** attempt)
+
+        def fetch():
+            with requests.Session() as session:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    tiles = list(executor.map(lambda bbox_string: fetch_tile(session, bbox_string),
+                                              bbox_strings))
+
+            self._count_bytes(sum(nbytes for _, nbytes in tiles))
+
+            # Nodes and ways have independent id spaces
+            elements = dict()
+            for tile, _ in tiles:
+                for element in tile:
+                    elements.setdefault((element['type'], element['id']), element)
+
+            return self._parse_overpass(list(elements.values()), est_type)
+
+        return self._cached(('overpass', [float(b) for b in bounds], est_type), fetch)
+
+    def _overpass_query(self, est_type):
+        '''
+        Util function to build the Overpass query for an establishment type.
+        '''
+
+        # Definir consulta para instalaciones de oferta de alimentos en Lima
         if est_type == 'food_supply':
             overpass_query = f"""
                 [timeout:120][out:json][bbox];
@@ -268,33 +787,79 @@ class HRUD(object):
                 out body geom;
                 """
 
-        # Request data
-        response = requests.get(overpass_url, params={'data': overpass_query,
-                                                      'bbox': bbox_string})
-        data = response.json()
+        return overpass_query
+
+    def _parse_overpass(self, elements, est_type):
+        '''
+        Util function to convert Overpass elements to GeoDataFrames. See download_overpass_poi.
+        '''
 
         if est_type != 'parks_pitches':
-            df = pd.DataFrame.from_dict(data['elements'])
+            df = pd.DataFrame.from_dict(elements)
             df_geom = gpd.points_from_xy(df['lon'], df['lat'])
             gdf = gpd.GeoDataFrame(df, geometry=df_geom)
 
             return gdf
 
         else:
-            df = pd.DataFrame.from_dict(data['elements'])
-
-            #Process nodes
-            nodes = df[df['type'] == 'node'].drop(['bounds', 'nodes', 'geometry'], axis=1)
-            node_geom = gpd.points_from_xy(nodes['lon'], nodes['lat'])
-            node_gdf = gpd.GeoDataFrame(nodes, geometry=node_geom)
+            return self._parse_parks_pitches(elements)
 
-            #Process ways
-            ways = df[df['type'] == 'way'].drop(['lat', 'lon'], axis=1)
-            ways['shell'] = ways['geometry'].apply(shell_from_geometry)
-            way_geom = ways['shell'].apply(Polygon)
-            way_gdf = gpd.GeoDataFrame(ways, geometry=way_geom)
+    def _parse_parks_pitches(self, elements):
+        '''
+        Util function to build the parks and pitches GeoDataFrames in bulk. Way vertices are
+        collected into flat coordinate arrays with ring offsets, so all polygons are created
+        in a single call instead of per element.
+        '''
 
-            return node_gdf, way_gdf
+        node_cols = {'id': [], 'lat': [], 'lon': [], 'tags': []}
+        way_cols = {'id': [], 'bounds': [], 'nodes': [], 'tags': []}
+        way_lon, way_lat, way_sizes = [], [], []
+
+        for element in elements:
+            if element['type'] == 'node':
+                node_cols['id'].append(element['id'])
+                node_cols['lat'].append(element['lat'])
+                node_cols['lon'].append(element['lon'])
+                node_cols['tags'].append(element.get('tags'))
+            elif element['type'] == 'way':
+                geometry = element.get('geometry', [])
+                way_cols['id'].append(element['id'])
+                way_cols['bounds'].append(element.get('bounds'))
+                way_cols['nodes'].append(element.get('nodes'))
+                way_cols['tags'].append(element.get('tags'))
+                way_lon.extend(map(_get_lon, geometry))
+                way_lat.extend(map(_get_lat, geometry))
+                way_sizes.append(len(geometry))
+
+        #Process nodes
+        nodes = pd.DataFrame(node_cols)
+        nodes.insert(0, 'type', 'node')
+        node_geom = gpd.points_from_xy(nodes['lon'], nodes['lat'])
+        node_gdf = gpd.GeoDataFrame(nodes, geometry=node_geom)
+
+        #Process ways
+        ways = pd.DataFrame(way_cols)
+        ways.insert(0, 'type', 'way')
+
+        way_sizes = np.asarray(way_sizes, dtype=np.int64)
+        coords = np.column_stack([np.asarray(way_lon, dtype=np.float64), np.asarray(way_lat, dtype=np.float64)])
+
+        # Degenerate ways (less than 3 distinct vertices) can't form a polygon
+        starts = np.cumsum(way_sizes) - way_sizes
+        valid = way_sizes >= 4
+        triangles = np.flatnonzero(way_sizes == 3)
+        valid[triangles] = (coords[starts[triangles]] != coords[starts[triangles] + 2]).any(axis=1)
+
+        way_geom = np.full(len(way_sizes), shapely.Polygon(), dtype=object)
+        if valid.any():
+            keep = np.repeat(valid, way_sizes)
+            ring_index = np.repeat(np.arange(valid.sum()), way_sizes[valid])
+            rings = shapely.linearrings(coords[keep], indices=ring_index)
+            way_geom[valid] = shapely.polygons(rings)
+
+        way_gdf = gpd.GeoDataFrame(ways, geometry=way_geom)
+
+        return node_gdf, way_gdf
 
     def shell_from_geometry(self, geometry):
         '''
@@ -306,7 +871,7 @@ class HRUD(object):
             shell.append([record['lon'], record['lat']])
         return shell
 
-    def gen_hexagons(self, resolution, city):
+    def gen_hexagons(self, resolution, city, n_jobs=1):
         '''
         Converts an input multipolygon layer to H3 hexagons given a resolution.
 
@@ -319,6 +884,12 @@ class HRUD(object):
         city: GeoDataFrame
               Input city polygons to transform into hexagons.
 
+        n_jobs: int
+                Number of worker processes used for the polyfill. Polygons are split into
+                vertical strips so large single polygons are also processed in parallel.
+                -1 uses all available cores. Areas under about a million hexagons are
+                always polyfilled in a single process.
+
         Returns
         -------
 
@@ -350,36 +921,82 @@ class HRUD(object):
 
         '''
 
+        h3_indexes = self._polyfill_city(resolution, city, n_jobs)
+        h3_polygons, h3_centroids = _hex_geometries(h3_indexes)
+
+        # Create hexagon dataframe
+        city_hexagons = gpd.GeoDataFrame(h3_indexes, geometry=h3_polygons, crs='EPSG:4326')
+        city_centroids = gpd.GeoDataFrame(h3_indexes, geometry=h3_centroids, crs='EPSG:4326')
+
+        return city_hexagons, city_centroids
+
+    def _polyfill_city(self, resolution, city, n_jobs):
+        '''
+        Util function to polyfill every polygon of the city. Returns the unique H3 indexes.
+        '''
+
+        # Get every polygon in Multipolygon shape
+        city_poly = city.explode(index_parts=False).geometry.values
+
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+
+        # Process start up costs more than the polyfill of a city sized area
+        if n_jobs > 1:
+            lat = np.radians(city_poly.centroid.y.mean())
+            area = city_poly.area.sum() * 111.32 ** 2 * np.cos(lat)
+            if area / h3.hex_area(resolution, 'km^2') < POLYFILL_PARALLEL_MIN_HEXAGONS:
+                n_jobs = 1
+
+        # Split large polygons so every worker gets a share of the polyfill
+        parts = list()
+        for polygon in city_poly:
+            parts.extend(_split_polygon(polygon, n_jobs))
+        geojsons = [part.__geo_interface__ for part in parts]
+
         # Polyfill the city boundaries
-        h3_centroids = list()
-        h3_polygons = list()
-        h3_indexes = list()
+        if n_jobs > 1 and len(geojsons) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                hexagons = list(executor.map(_polyfill, geojsons, [resolution] * len(geojsons)))
+        else:
+            hexagons = [_polyfill(geojson, resolution) for geojson in geojsons]
 
-        # Get every polygon in Multipolygon shape
-        city_poly = city.explode().reset_index(drop=True)
+        # Dedupe on the H3 index instead of the geometry
+        h3_indexes = pd.unique(np.array([hexagon for part in hexagons for hexagon in part], dtype=object))
 
-        for ix, geo in city_poly.iterrows():
-            hexagons = h3.polyfill(geo['geometry'].__geo_interface__, res=resolution, \
-                                    geo_json_conformant=True)
-            for hexagon in hexagons:
-                centroid_lat, centroid_lon = h3.h3_to_geo(hexagon) # format as x,y (lon, lat)
-                h3_centroids.append(Point(centroid_lon, centroid_lat))
+        return h3_indexes
 
-                h3_geo_boundary = h3.h3_to_geo_boundary(hexagon)
-                [bound.reverse() for bound in h3_geo_boundary] # format as x,y (lon, lat)
-                h3_polygons.append(Polygon(h3_geo_boundary))
+    def gen_hexgrid(self, resolution, city, n_jobs=1):
+        '''
+        Converts an input multipolygon layer to a compact HexGrid given a resolution.
+        Unlike gen_hexagons, no geometry is built until the grid is exported.
 
-                h3_indexes.append(hexagon)
+        Parameters
+        ----------
 
-        # Create hexagon dataframe
-        city_hexagons = gpd.GeoDataFrame(h3_indexes, geometry=h3_polygons).drop_duplicates()
-        city_hexagons.crs = 'EPSG:4326'
-        city_centroids = gpd.GeoDataFrame(h3_indexes, geometry=h3_centroids).drop_duplicates()
-        city_centroids.crs = 'EPSG:4326'
+        resolution, city, n_jobs: see gen_hexagons
 
-        return city_hexagons, city_centroids
+        Returns
+        -------
+
+        grid: HexGrid
+              Grid with the uint64 H3 indexes of the city
+
+        Example
+        -------
+
+        >> lima_grid = gen_hexgrid(9, lima)
+        >> lima_grid.aggregate_points(pop_lima, {'population_2020': 'sum'})
+        >> lima_hex, lima_centroids = lima_grid.to_gdf(), lima_grid.to_gdf(centroids=True)
 
-    def merge_shape_hex(self, hex, shape, how, op, agg):
+        '''
+
+        from .hexgrid import HexGrid # hexgrid imports the H3 helpers from this module
+
+        h3_indexes = self._polyfill_city(resolution, city, n_jobs)
+        return HexGrid(_h3_to_int(h3_indexes), resolution=resolution)
+
+    def merge_shape_hex(self, hex, shape, how, op, agg, method='sjoin', hex_col=0):
         '''
         Merges a H3 hexagon GeoDataFrame with a Point GeoDataFrame and aggregates the
         point gdf data.
@@ -401,7 +1018,14 @@ class HRUD(object):
                  geometries are queried for merging.
 
         agg: dict. A dictionary with column names as keys and values as aggregation
-             operations. The aggregation must be one of {'sum', 'min', 'max'}.
+             operations. The aggregation must be one of {'sum', 'min', 'max', 'count'}.
+
+        method: str. One of {'sjoin', 'h3'}. 'sjoin' runs a spatial join between points
+                and hexagons. 'h3' computes the H3 index of every point directly from its
+                coordinates and groups by index, skipping the spatial join. 'h3' only
+                supports point geometries and ignores how and op.
+
+        hex_col: column name in hex containing the H3 indexes. Only used with method='h3'.
 
         Returns
         -------
@@ -426,6 +1050,9 @@ class HRUD(object):
         888e628debfffff | POLYGON ((-76.67982 -12.18998, -76.68413 -12.1... | NaN
         888e6299b3fffff | POLYGON ((-76.78876 -11.97286, -76.79307 -11.9... | 3225.658803
         '''
+        if method == 'h3':
+            return self._merge_points_h3(hex, shape, agg, hex_col)
+
         joined = gpd.sjoin(shape, hex, how=how, op=op)
 
         #Uses index right based on the order of points and hex. Right takes hex index
@@ -439,6 +1066,295 @@ class HRUD(object):
 
         return ret_hex
 
+    def _merge_points_h3(self, hex, shape, agg, hex_col):
+        '''
+        H3 aggregation backend for merge_shape_hex. Points are indexed in bulk at the
+        resolution of the hexagons and aggregated with a groupby on the uint64 index.
+        '''
+
+        resolution = h3.h3_get_resolution(hex[hex_col].iloc[0])
+        hex_merge = _aggregate_points(shape, resolution, agg).reindex(_h3_to_int(hex[hex_col].values))
+
+        #Avoid SpecificationError by copying the DataFrame
+        ret_hex = hex.copy()
+
+        for key in agg.keys():
+            ret_hex[key] = hex_merge[key].values
+
+        return ret_hex
+
+    def read_inei_census(self, path, level='zona'):
+        '''
+        Read an INEI 2017 census CSV (zona or manzana data) with compact dtypes and the
+        polygon ID used by the INEI shapefiles.
+
+        Parameters
+        ----------
+
+        path: str
+              CSV path, e.g. inputs/inei_2017_data/inei2017_zona_data_poblacion.csv
+
+        level: str. One of {'zona', 'manzana'}. Builds IDZONA or IDMANZANA.
+
+        Returns
+        -------
+
+        census: DataFrame
+                Census table. Code and name columns (UBIGEO, DISTRITO, ...) are categorical
+                and counts are downcast to the smallest integer type that holds them.
+
+        Example
+        -------
+
+        >> zonas = read_inei_census('inputs/inei_2017_data/inei2017_zona_data_poblacion.csv')
+        >> zonas[['IDZONA', 'UBIGEO', 'POB_TOTAL']].head()
+
+        IDZONA        | UBIGEO | POB_TOTAL
+        07010100100   | 070101 | 5609
+        07010100200   | 070101 | 5435
+        07010100300   | 070101 | 4279
+
+        '''
+
+        if level not in ('zona', 'manzana'):
+            raise ValueError(f"level must be 'zona' or 'manzana', got {level!r}")
+
+        header = pd.read_csv(path, nrows=0).columns
+        code_columns = [column for column in header if column in INEI_CODE_COLUMNS]
+        census = pd.read_csv(path, dtype={column: str for column in code_columns})
+
+        ubigeo = census['UBIGEO'].str.zfill(6)
+        zona = census['ZONA_ID'].str.zfill(3)
+        sufzona = census['ZONA_A'].fillna('00').replace(ZONA_A_TO_SUFZONA)
+        if level == 'zona':
+            census.insert(0, 'IDZONA', ubigeo + zona + sufzona)
+        else:
+            census.insert(0, 'IDMANZANA', ubigeo + zona + sufzona + census['MANZANA_ID'] +
+                          census['MANZANA_A'].fillna('0'))
+
+        census['UBIGEO'] = ubigeo
+        for column in code_columns:
+            census[column] = census[column].astype('category')
+
+        for column in census.columns.drop(code_columns).drop(f'ID{level.upper()}'):
+            if census[column].dtype.kind == 'i':
+                census[column] = pd.to_numeric(census[column], downcast='unsigned' if census[column].min() >= 0 else 'integer')
+            elif census[column].dtype.kind == 'f':
+                census[column] = census[column].astype(np.float32)
+
+        return census
+
+    def interpolate_area(self, source, hex, extensive=(), intensive=(), crs=None, n_jobs=1,
+                         chunksize=50000):
+        '''
+        Areal interpolation of polygon attributes (e.g. INEI zonas or manzanas) onto hexagons.
+        Extensive variables (counts) are split by the share of the source polygon area that
+        falls in each hexagon. Intensive variables (rates, averages) are averaged weighted by
+        the intersection area.
+
+        Candidate pairs come from an STRtree over the hexagons. Hexagons fully inside a
+        source polygon and source polygons fully inside a hexagon take their area directly,
+        so exact intersections are only computed for pairs crossing polygon edges.
+
+        Parameters
+        ----------
+
+        source: GeoDataFrame
+                Polygons with the attributes to interpolate, e.g. a zona shapefile merged
+                with read_inei_census
+
+        hex: GeoDataFrame
+             Result from gen_hexagons
+
+        extensive: list
+                   Count columns (e.g. ['POB_TOTAL', 'GRUPO_Q1'])
+
+        intensive: list
+                   Rate columns
+
+        crs: CRS, optional
+             Equal area CRS used to measure areas (e.g. 'EPSG:32718'). If None, areas are
+             measured in the CRS of the inputs, which is close enough for shares of small
+             polygons in EPSG 4326.
+
+        n_jobs: int
+                Number of worker processes for the exact intersections. -1 uses all cores.
+
+        chunksize: int
+                   Number of polygon pairs sent to each worker task
+
+        Returns
+        -------
+
+        hex: GeoDataFrame
+             Copy of hex with the interpolated columns. Hexagons without source polygons
+             get 0 in extensive columns and NaN in intensive columns.
+
+        Example
+        -------
+
+        >> zonas = gdf_zonas.merge(read_inei_census(zona_csv), on='IDZONA')
+        >> lima_hex, _ = gen_hexagons(9, lima)
+        >> interpolate_area(zonas, lima_hex, extensive=['POB_TOTAL'], crs='EPSG:32718')
+
+        0               | geometry                                          | POB_TOTAL
+        898e62c8003ffff | POLYGON ((-77.04312 -12.04118, -77.04409 -12.0... | 412.338
+        898e62c8007ffff | POLYGON ((-77.04181 -12.04449, -77.04279 -12.0... | 398.014
+
+        '''
+
+        if source.crs != hex.crs:
+            source = source.to_crs(hex.crs)
+
+        source_geoms = (source.to_crs(crs) if crs is not None else source).geometry.values.data
+        hex_geoms = (hex.to_crs(crs) if crs is not None else hex).geometry.values.data
+
+        source_area = shapely.area(source_geoms)
+        hex_area = shapely.area(hex_geoms)
+
+        tree = shapely.STRtree(hex_geoms)
+        source_idx, hex_idx = tree.query(source_geoms, predicate='intersects')
+
+        # Fast paths: one geometry inside the other
+        shapely.prepare(source_geoms)
+        shapely.prepare(hex_geoms)
+        areas = np.full(len(source_idx), np.nan)
+        hex_inside = shapely.contains_properly(source_geoms[source_idx], hex_geoms[hex_idx])
+        areas[hex_inside] = hex_area[hex_idx[hex_inside]]
+        source_inside = ~hex_inside & shapely.contains_properly(hex_geoms[hex_idx], source_geoms[source_idx])
+        areas[source_inside] = source_area[source_idx[source_inside]]
+
+        edges = np.flatnonzero(np.isnan(areas))
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+
+        if n_jobs > 1 and len(edges) > chunksize:
+            chunks = [edges[i:i + chunksize] for i in range(0, len(edges), chunksize)]
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = executor.map(_intersection_areas,
+                                       [source_geoms[source_idx[chunk]] for chunk in chunks],
+                                       [hex_geoms[hex_idx[chunk]] for chunk in chunks])
+                areas[edges] = np.concatenate(list(results))
+        else:
+            areas[edges] = _intersection_areas(source_geoms[source_idx[edges]], hex_geoms[hex_idx[edges]])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(source_area[source_idx] > 0, areas / source_area[source_idx], 0)
+
+        ret_hex = hex.copy()
+        n_hex = len(hex)
+
+        for column in extensive:
+            values = np.nan_to_num(source[column].values.astype(np.float64))
+            ret_hex[column] = np.bincount(hex_idx, weights=shares * values[source_idx], minlength=n_hex)
+
+        for column in intensive:
+            values = source[column].values.astype(np.float64)[source_idx]
+            valid = ~np.isnan(values)
+            weights = np.bincount(hex_idx[valid], weights=areas[valid], minlength=n_hex)
+            weighted = np.bincount(hex_idx[valid], weights=areas[valid] * values[valid], minlength=n_hex)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ret_hex[column] = np.where(weights > 0, weighted / weights, np.nan)
+
+        return ret_hex
+
+    def merge_nse_hex(self, blocks, hex, nse_col='Nse07', pop_col='Pob07', hex_col=0, n_jobs=1):
+        '''
+        Population weighted socioeconomic level (NSE) distribution per hexagon from the
+        city block layer (inputs/manzanas_nse/mz_lima_region).
+
+        Every block is looked up by the H3 index of its bbox center, and blocks contained in
+        that hexagon (a prepared geometry test) are assigned to it directly. Only blocks
+        crossing cell edges are split between hexagons by intersection area, with the
+        STRtree search of interpolate_area.
+
+        Parameters
+        ----------
+
+        blocks: GeoDataFrame
+                City blocks in EPSG 4326 with the NSE class and population columns
+
+        hex: GeoDataFrame
+             Result from gen_hexagons
+
+        nse_col: column name of the NSE class
+
+        pop_col: column name of the block population
+
+        hex_col: column name in hex containing the H3 indexes
+
+        n_jobs: int
+                Number of worker processes for the exact intersections
+
+        Returns
+        -------
+
+        hex: GeoDataFrame
+             Copy of hex with the total population (pop_col), the population of every NSE
+             class ({pop_col}_{class}) and its share of the classified population
+             ({nse_col}_{class}). Blocks outside the hexagons are dropped.
+
+        Example
+        -------
+
+        >> blocks = gpd.read_file('inputs/manzanas_nse/mz_lima_region.shp')
+        >> lima_hex, _ = gen_hexagons(9, lima)
+        >> merge_nse_hex(blocks, lima_hex)
+
+        0               | geometry             | Pob07  | Pob07_A | ... | Nse07_A | ... | Nse07_E
+        898e62c8003ffff | POLYGON ((-77.04...  | 1824.0 | 0.0     | ... | 0.0     | ... | 0.12
+        898e62c8007ffff | POLYGON ((-77.04...  | 2210.5 | 310.2   | ... | 0.14    | ... | 0.0
+
+        '''
+
+        hex_ints = _h3_to_int(hex[hex_col].values)
+        resolution = int(h3_vect.h3_get_resolution(hex_ints[:1])[0])
+
+        classes = sorted(blocks[nse_col].dropna().unique())
+        codes = pd.Categorical(blocks[nse_col], categories=classes).codes
+        population = np.nan_to_num(blocks[pop_col].values.astype(np.float64))
+
+        # Celda H3 del centro del bbox: si la contiene, la manzana se asigna sin intersección
+        geoms = blocks.geometry.values.data
+        bounds = np.nan_to_num(shapely.bounds(geoms))
+        cells = h3_vect.geo_to_h3((bounds[:, 1] + bounds[:, 3]) / 2, (bounds[:, 0] + bounds[:, 2]) / 2, resolution)
+
+        hex_geoms = hex.geometry.values.data
+        shapely.prepare(hex_geoms)
+        positions = pd.Index(hex_ints).get_indexer(cells)
+        inside = positions >= 0
+        inside[inside] = shapely.contains_properly(hex_geoms[positions[inside]], geoms[inside])
+
+        # Population by hexagon and class. Blocks without NSE (code -1) go to the last column
+        n_classes = len(classes) + 1
+        class_pop = np.zeros((len(hex), n_classes))
+
+        np.add.at(class_pop, (positions[inside], codes[inside]), population[inside])
+
+        edge = ~inside & ~shapely.is_empty(geoms)
+        if edge.any():
+            columns = [f'_class_{code}' for code in range(n_classes)]
+            edge_codes = np.where(codes[edge] < 0, n_classes - 1, codes[edge])
+            edge_pop = population[edge]
+            edge_blocks = gpd.GeoDataFrame(
+                {column: np.where(edge_codes == code, edge_pop, 0) for code, column in enumerate(columns)},
+                geometry=blocks.geometry.values[edge], crs=blocks.crs)
+            edge_hex = self.interpolate_area(edge_blocks, hex[[hex_col, hex.geometry.name]], extensive=columns,
+                                             n_jobs=n_jobs)
+            class_pop += edge_hex[columns].values
+
+        ret_hex = hex.copy()
+        ret_hex[pop_col] = class_pop.sum(axis=1)
+
+        classified = class_pop[:, :-1].sum(axis=1)
+        for code, nse in enumerate(classes):
+            ret_hex[f'{pop_col}_{nse}'] = class_pop[:, code]
+        for code, nse in enumerate(classes):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ret_hex[f'{nse_col}_{nse}'] = np.where(classified > 0, class_pop[:, code] / classified, np.nan)
+
+        return ret_hex
+
     def swap_xy(self, geom):
         '''
         Util function in case an x,y coordinate needs to be switched
@@ -487,16 +1403,19 @@ class HRUD(object):
         else:
             raise ValueError('Type %r not recognized' % geom.type)
 
-    def nn_search(self, tree_features, query_features, metric='haversine', convert_radians=False):
+    def nn_search(self, tree_features, query_features, metric='haversine', convert_radians=False, n_jobs=1):
         '''
-        Build a BallTree for nearest neighbor search based on haversine distance.
+        Nearest neighbor distance based on haversine distance. The search runs on a
+        FacilityIndex that is kept on the HRUD object, so repeated searches against the
+        same tree features (e.g. one facility set and several hexagon layers) build the
+        BallTree once.
 
         Parameters
         ----------
 
-        tree_features: array_like
+        tree_features: array_like or FacilityIndex
                        Input features to create the search tree. Features are in
-                       lat, lon format, in radians
+                       lat, lon format, in radians. An existing FacilityIndex is used as is
 
         query_features: array_like
                         Points to which calculate the nearest neighbor within the tree.
@@ -504,10 +1423,15 @@ class HRUD(object):
 
         metric: str
                 Distance metric for neighorhood search. Default haversine for latlon coordinates.
+                Other metrics build a BallTree on every call
 
         convert_radians: bool
                          Flag in case features are not in radians and need to be converted
 
+        n_jobs: int
+                Number of threads the query array is split across (not processes), see
+                FacilityIndex.query
+
         Returns
         -------
 
@@ -516,13 +1440,190 @@ class HRUD(object):
 
         '''
 
+        query_features = np.asarray(query_features, dtype=np.float64)
+        if convert_radians:
+            query_features = np.radians(query_features)
+
+        if isinstance(tree_features, FacilityIndex):
+            return tree_features.query(query_features[:, 0], query_features[:, 1], n_jobs=n_jobs)[0]
+
+        tree_features = np.asarray(tree_features, dtype=np.float64)
         if convert_radians:
-            pass
+            tree_features = np.radians(tree_features)
+
+        if metric != 'haversine':
+            tree = BallTree(tree_features, metric=metric)
+            return tree.query(query_features)[0] * EARTH_RADIUS_KM
+
+        index = self._nn_index(tree_features)
+        return index.query(query_features[:, 0], query_features[:, 1], n_jobs=n_jobs)[0]
+
+    def _nn_index(self, tree_features):
+        '''
+        Util function to get the FacilityIndex of tree features in radians, reusing the
+        ones built by previous nn_search calls.
+        '''
+
+        key = hashlib.sha1(np.ascontiguousarray(tree_features).tobytes()).hexdigest()
+        if key not in self._nn_indexes:
+            # Solo se guardan los últimos índices
+            while len(self._nn_indexes) >= NN_INDEX_CACHE_SIZE:
+                self._nn_indexes.pop(next(iter(self._nn_indexes)))
+            self._nn_indexes[key] = FacilityIndex(tree_features[:, 0], tree_features[:, 1], degrees=False)
 
-        tree = BallTree(tree_features, metric=metric)
-        return tree.query(query_features)[0] * 6371000/1000
+        return self._nn_indexes[key]
+
+    def facility_index(self, facilities, **kwargs):
+        '''
+        Build a reusable nearest neighbor index for a set of facilities, the engine behind
+        nn_search. The index supports k-nearest and radius queries returning distances and
+        indices, and can be saved to and loaded from disk.
+
+        Parameters
+        ----------
+
+        facilities: GeoDataFrame
+                    Point GeoDataFrame in EPSG 4326 with the facilities
+
+        kwargs: Additional arguments passed to FacilityIndex
+
+        Returns
+        -------
+
+        index: FacilityIndex
+
+        Example
+        -------
+
+        >> markets_index = facility_index(sjl_old_markets)
+        >> distances, indices = markets_index.query(sjl_hexs_centroids, k=1)
+
+        '''
+
+        return FacilityIndex.from_gdf(facilities, **kwargs)
+
+    def catchment(self, population, facilities, centroids=None, costs=None, capacity=None,
+                  active=None, max_cost=None):
+        '''
+        Assign every hexagon to its nearest facility and compute the population served by
+        each facility. All the aggregation is done with array operations, so it can be
+        re-run cheaply for every scenario of active facilities.
+
+        Parameters
+        ----------
+
+        population: array_like (n,)
+                    Population of each hexagon (e.g. population_2020 from merge_shape_hex)
+
+        facilities: GeoDataFrame (m,)
+                    Facilities (e.g. markets). Point geometries in EPSG 4326
+
+        centroids: GeoDataFrame (n,), optional
+                   Hexagon centroids from gen_hexagons. Used to assign hexagons by haversine
+                   distance when costs is not provided
+
+        costs: array_like (n, m), optional
+               Distance or travel time between every hexagon and facility (e.g. durations
+               from OSRMClient.table). NaN for unreachable pairs
+
+        capacity: array_like (m,), optional
+                  Capacity (aforo) of each facility. See market_capacity
+
+        active: array_like (m,), optional
+                Boolean mask of the facilities active in the scenario. Default all active
+
+        max_cost: float, optional
+                  Hexagons farther than max_cost from every active facility (km for haversine
+                  distances, cost units otherwise) are left unserved
+
+        Returns
+        -------
+
+        hex_facility: ndarray (n,)
+                      Positional index of the facility assigned to each hexagon, -1 if unserved
+
+        facility_stats: DataFrame
+                        catchment_population, capacity and load_ratio (population / capacity)
+                        per facility, indexed as facilities
+
+        unserved_population: float
+                             Population of the hexagons without an assigned facility
+
+        Example
+        -------
+
+        >> markets['aforo'] = market_capacity(markets['Area construida'], markets['Tipo de mercado'])
+        >> hex_facility, stats, unserved = catchment(sjl_hexs['population_2020'], markets,
+                                                     centroids=sjl_hexs_centroids,
+                                                     capacity=markets['aforo'], max_cost=2)
+        >> stats.head()
+            catchment_population | capacity | load_ratio
+            15230.1              | 1200     | 12.69
+
+        '''
+
+        population = np.nan_to_num(np.asarray(population, dtype=np.float64))
+        n_facilities = len(facilities)
+        active = np.ones(n_facilities, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+
+        if costs is not None:
+            masked_costs = np.where(active[None, :], np.asarray(costs, dtype=np.float64), np.inf)
+            masked_costs = np.where(np.isnan(masked_costs), np.inf, masked_costs)
+            hex_facility = masked_costs.argmin(axis=1)
+            hex_cost = masked_costs[np.arange(len(hex_facility)), hex_facility]
+        elif not active.any():
+            # Sin instalaciones activas todos los hexágonos quedan sin atender
+            hex_facility = np.full(len(population), -1)
+            hex_cost = np.full(len(population), np.inf)
+        else:
+            active_ix = np.flatnonzero(active)
+            index = FacilityIndex.from_gdf(facilities.iloc[active_ix])
+            hex_cost, nearest = index.query(centroids, k=1)
+            hex_facility = active_ix[nearest[:, 0]]
+            hex_cost = hex_cost[:, 0]
+
+        served = np.isfinite(hex_cost)
+        if max_cost is not None:
+            served &= hex_cost <= max_cost
+        hex_facility = np.where(served, hex_facility, -1)
+
+        catchment_population = np.bincount(hex_facility[served], weights=population[served],
+                                           minlength=n_facilities).astype(np.float64)
+
+        facility_stats = pd.DataFrame({'catchment_population': catchment_population}, index=facilities.index)
+        if capacity is not None:
+            capacity = np.asarray(capacity, dtype=np.float64)
+            facility_stats['capacity'] = capacity
+            with np.errstate(divide='ignore', invalid='ignore'):
+                facility_stats['load_ratio'] = catchment_population / capacity
+
+        unserved_population = population[~served].sum()
+
+        return hex_facility, facility_stats, unserved_population
+
+    def market_capacity(self, area, market_type):
+        '''
+        Capacity (aforo) of a market from its built area: 2 people per m2 for retail
+        markets ('Minorista') and 5 otherwise.
+
+        Parameters
+        ----------
+
+        area: array_like
+              Built area (Area construida) of each market
+
+        market_type: array_like
+                     Market type (Tipo de mercado) of each market
+
+        Returns
+        -------
+
+        capacity: ndarray
+        '''
+
+        area = np.asarray(area, dtype=np.float64)
+        return np.where(np.asarray(market_type) == 'Minorista', area * 2, area * 5)
 
-    @jit
     def tuples_to_lists(self, json):
         '''
         Util function to convert the geo interface of a GeoDataFrame to PyDeck GeoJSON format.
@@ -549,9 +1650,9 @@ class HRUD(object):
 
         return json
 
-    def pydeck_df(self, gdf, features, cmap, bins, color_feature):
+    def pydeck_df(self, gdf, features, cmap, bins, color_feature, layer_type='PolygonLayer', hex_col=0):
         '''
-        Prepare a DataFrame for Polygon plotting in PyDeck
+        Prepare a DataFrame for Polygon or H3Hexagon plotting in PyDeck
 
         Parameters
         ----------
@@ -566,53 +1667,206 @@ class HRUD(object):
               Bins to aggregate data into
         color_feature: str
                        Column name for data to transform into bins and color features
+        layer_type: str. One of {'PolygonLayer', 'H3HexagonLayer'}
+                    'PolygonLayer' adds the exterior ring coordinates of every geometry.
+                    'H3HexagonLayer' only adds the hex ids, taken from hex_col.
+        hex_col: column name in gdf containing the H3 indexes. Only used with 'H3HexagonLayer'
 
         Returns
         -------
 
         polygon_df: DataFrame
-                    df with the coordinates in a list as a column and the selected features
+                    df with the coordinates in a list (or the hex id) as a column and the selected features
         '''
 
-        cmap = plt.get_cmap(name='magma')
-        json = gdf.__geo_interface__
+        cmap = plt.get_cmap(name=cmap)
+        color_table = np.round(cmap(np.linspace(0, 1, 256))[:, :3] * 255, 0)
 
-        json_ = self.tuples_to_lists(json)
+        polygon_df = pd.DataFrame(index=pd.RangeIndex(len(gdf)))
 
-        del json_['bbox']
-        
-        df = pd.DataFrame.from_dict(json_)
+        if layer_type == 'H3HexagonLayer':
+            polygon_df['hex'] = gdf[hex_col].values
+        else:
+            # Exterior rings straight from the geometry arrays
+            rings = shapely.get_exterior_ring(gdf.geometry.values.data)
+            coords = shapely.get_coordinates(rings)
+            n_coords = shapely.get_num_coordinates(rings)
 
-        polygon_df = pd.DataFrame()
-        polygon_df['coordinates'] = df['features'].apply(lambda row: row['geometry']['coordinates'])
+            if len(gdf) > 0 and (n_coords == n_coords[0]).all(): # e.g. hexagons, no pentagons
+                rings = coords.reshape(len(gdf), 1, n_coords[0], 2).tolist()
+            else:
+                coords = coords.tolist()
+                offsets = np.concatenate([[0], np.cumsum(n_coords)])
+                rings = [[coords[start:end]] for start, end in zip(offsets[:-1], offsets[1:])]
+
+            polygon_df['coordinates'] = rings
 
         for feature in features:
-            polygon_df[feature] = df['features'].apply(lambda row: row['properties'][feature])
+            polygon_df[feature] = gdf[feature].values
 
-        print()
         polygon_df['bins'] = pd.cut(
             polygon_df[color_feature],
             bins = bins
         )
 
-        bins_labels = polygon_df['bins'].unique().categories.values
-        bins_replace = {label: i  for i, label in enumerate(bins_labels)}
-        polygon_df['count'] = polygon_df['bins'].replace(bins_replace)
-
-        cmap_ixs = [int(round(255 / (i+1))) for i in polygon_df['count'].fillna(0).values]
-        rgb_values = [[color * 255 for color in cmap.colors[cmap_ix]] for cmap_ix in cmap_ixs]
-        rgb_count_df = pd.DataFrame(rgb_values, columns=['r','g','b'])
+        codes = polygon_df['bins'].cat.codes.values
+        polygon_df['count'] = np.where(codes >= 0, codes, np.nan)
 
-        polygon_df = pd.concat((polygon_df, rgb_count_df), axis=1)
-
-        polygon_df['r'] = polygon_df['r'].round(0)
-        polygon_df['g'] = polygon_df['g'].round(0)
-        polygon_df['b'] = polygon_df['b'].round(0)
+        cmap_ixs = np.round(255 / (np.maximum(codes, 0) + 1)).astype(int)
+        polygon_df[['r', 'g', 'b']] = color_table[cmap_ixs]
 
         return polygon_df
 
     def gen_pydeck_layer(self, layer_type, data, **kwargs):
         if layer_type == 'H3HexagonLayer':
+            kwargs.setdefault('get_hexagon', 'hex')
+            kwargs.setdefault('get_fill_color', '[r, g, b]')
             return pdk.Layer("H3HexagonLayer", data, **kwargs)
         else:
             return pdk.Layer('PolygonLayer', data, **kwargs)
+
+    def export_hex(self, hex, path, columns=None, geometry=True, hex_col=0):
+        '''
+        Write a hexagon layer as GeoParquet (.parquet) or Arrow IPC (.arrow, .feather),
+        much smaller and faster to write and parse than GeoJSON. The H3 index column is
+        written as 'hex'.
+
+        Parameters
+        ----------
+
+        hex: GeoDataFrame
+             Hexagon layer, e.g. result from merge_shape_hex
+
+        path: str
+              Output file. The format is taken from the extension
+
+        columns: list, optional
+                 Indicator columns to write. Default all
+
+        geometry: bool
+                  Write the polygons. Layers drawn with an H3HexagonLayer only need the
+                  hex ids, so the geometry can be left out
+
+        hex_col: column name in hex containing the H3 indexes
+
+        Example
+        -------
+
+        >> export_hex(lima_hex_pop, 'outputs/lima_9.parquet', geometry=False)
+
+        '''
+
+        columns = [column for column in hex.columns if column not in (hex_col, hex.geometry.name)] \
+            if columns is None else list(columns)
+
+        frame = pd.DataFrame({'hex': hex[hex_col].values})
+        for column in columns:
+            frame[column] = hex[column].values
+        if geometry:
+            frame = gpd.GeoDataFrame(frame, geometry=hex.geometry.values, crs=hex.crs)
+
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.parquet':
+            frame.to_parquet(path, index=False)
+        elif extension in ('.arrow', '.feather'):
+            frame.to_feather(path)
+        else:
+            raise ValueError(f'Unknown output format {extension!r}, use .parquet, .arrow or .feather')
+
+    def export_tiles(self, pyramid, output_dir, columns=None, zooms=None, decimals=2):
+        '''
+        Write the levels of a HexPyramid as compact per zoom tile sets for the dashboard.
+        Every hexagon goes to the XYZ (web mercator) tile containing its centroid, and each
+        tile is a columnar JSON with the H3 ids and indicator values, e.g.
+        output_dir/13/2243/4378.json = {"hex": [...], "population_2020": [...]}.
+        The dashboard only downloads the tiles in view, at the resolution of its zoom.
+
+        output_dir/tiles.json lists the zoom -> resolution mapping, the columns and the
+        available tiles of every zoom. Tiles of a previous export to output_dir (its zoom
+        directories) are removed first, so the index describes every tile on disk.
+
+        Parameters
+        ----------
+
+        pyramid: HexPyramid
+
+        output_dir: str
+
+        columns: list, optional
+                 Indicator columns to write. Default all
+
+        zooms: dict, optional
+               Map zoom as keys and pyramid resolution as values. Default resolution + 4
+               for every level (res 9 at zoom 13)
+
+        decimals: int
+                  Decimals kept in the indicator values
+
+        Returns
+        -------
+
+        n_tiles: dict
+                 Number of tiles written per zoom
+
+        Example
+        -------
+
+        >> pyramid = HexPyramid.from_hex(lima_hex_pop, 9, [7, 8], sums=['population_2020'])
+        >> export_tiles(pyramid, 'outputs/tiles', zooms={11: 7, 12: 8, 13: 9, 14: 9})
+        {11: 4, 12: 9, 13: 30, 14: 106}
+
+        '''
+
+        if zooms is None:
+            zooms = {resolution + 4: resolution for resolution in [pyramid.resolution] + pyramid.resolutions}
+
+        # Borrar las teselas de una exportación anterior
+        if os.path.isdir(output_dir):
+            for name in os.listdir(output_dir):
+                if name.isdigit() and os.path.isdir(os.path.join(output_dir, name)):
+                    shutil.rmtree(os.path.join(output_dir, name))
+
+        index = {'format': 'h3-json', 'zooms': dict(), 'columns': dict(), 'tiles': dict()}
+        n_tiles = dict()
+
+        for zoom, resolution in sorted(zooms.items()):
+            level = pyramid.level(resolution)
+            level_columns = list(level.columns) if columns is None else list(columns)
+
+            h3_indexes = _int_to_h3(level.index.values)
+            centroids = np.array([h3.h3_to_geo(hexagon) for hexagon in h3_indexes]).reshape(-1, 2)
+
+            # Tesela XYZ del centroide
+            n = 2 ** zoom
+            lat = np.radians(centroids[:, 0])
+            x = np.floor((centroids[:, 1] + 180) / 360 * n).astype(np.int64)
+            y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n).astype(np.int64)
+
+            values = level[level_columns].round(decimals)
+            tiles = pd.DataFrame({'x': x, 'y': y}).groupby(['x', 'y']).indices
+
+            for (tile_x, tile_y), rows in tiles.items():
+                tile = {'hex': h3_indexes[rows].tolist()}
+                for column in level_columns:
+                    # JSON has no NaN
+                    tile[column] = values[column].values[rows].astype(object)
+                    tile[column][pd.isna(values[column].values[rows])] = None
+                    tile[column] = tile[column].tolist()
+
+                tile_dir = os.path.join(output_dir, str(zoom), str(tile_x))
+                os.makedirs(tile_dir, exist_ok=True)
+                with open(os.path.join(tile_dir, f'{tile_y}.json'), 'w') as f:
+                    json.dump(tile, f, separators=(',', ':'))
+
+            index['zooms'][str(zoom)] = resolution
+            index['columns'][str(zoom)] = level_columns
+            index['tiles'][str(zoom)] = [[int(tile_x), int(tile_y)] for tile_x, tile_y in tiles]
+            n_tiles[zoom] = len(tiles)
+
+        os.makedirs(output_dir, exist_ok=True)
+        index_path = os.path.join(output_dir, 'tiles.json')
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(f'{index_path}.tmp', index_path)
+
+        return n_tiles
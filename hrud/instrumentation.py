@@ -0,0 +1,218 @@
+import sys
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Instrumentation(object):
+    '''
+    Opt-in per stage metrics for HRUD. Every instrumented call produces a record with
+    wall time, peak memory, input and output row counts and network bytes, which is sent
+    to each sink.
+
+    Parameters
+    ----------
+
+    sinks: list
+           Objects with an emit(record) method, e.g. JSONLogSink or MetricsRegistry
+
+    track_memory: bool
+                  Measure peak memory with tracemalloc. Tracing slows down allocations,
+                  so it can be turned off to measure only times and rows.
+
+    Example
+    -------
+
+    >> registry = MetricsRegistry()
+    >> hrud = HRUD()
+    >> hrud.instrument([JSONLogSink(), registry])
+    >> lima = hrud.download_osm(2, 'Lima, Peru')
+    {"method": "download_osm", "seconds": 1.52, "peak_bytes": 2411520, "input_rows": 0, "output_rows": 1, "network_bytes": 1843201}
+    >> with hrud.instrumentation.stage('notebook_cell'):
+    ..     ...
+    >> print(registry.exposition())
+
+    '''
+
+    def __init__(self, sinks=None, track_memory=True):
+        self.sinks = list(sinks or [])
+        self.track_memory = track_memory
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name, inputs=()):
+        '''
+        Record a block of code as a stage. The yielded dict can be updated with
+        output_rows and any extra field.
+        '''
+
+        stack = self._stack()
+        if stack:
+            stack[-1]['max_peak'] = max(stack[-1]['max_peak'], self._peak())
+
+        started_tracing = False
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+
+        frame = {'max_peak': 0, 'network_bytes': 0,
+                 'start_memory': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0}
+        self._reset_peak()
+        stack.append(frame)
+
+        record = {'method': name, 'input_rows': _rows(inputs)}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            stack.pop()
+
+            peak = max(frame['max_peak'], self._peak())
+            record['peak_bytes'] = max(peak - frame['start_memory'], 0) if self.track_memory else None
+            record['network_bytes'] = frame['network_bytes']
+            record.setdefault('output_rows', None)
+
+            if stack:
+                stack[-1]['max_peak'] = max(stack[-1]['max_peak'], peak)
+                stack[-1]['network_bytes'] += frame['network_bytes']
+                self._reset_peak()
+            if started_tracing:
+                tracemalloc.stop()
+
+            for sink in self.sinks:
+                sink.emit(record)
+
+    def add_network_bytes(self, nbytes):
+        '''
+        Add downloaded bytes to the current stage.
+        '''
+
+        stack = self._stack()
+        if stack:
+            stack[-1]['network_bytes'] += nbytes
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def _peak(self):
+        return tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+
+    def _reset_peak(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+
+def instrumented(method):
+    '''
+    Decorator recording a call of an HRUD method when its instrumentation is enabled.
+    When it is disabled the overhead is a single attribute lookup.
+    '''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return method(self, *args, **kwargs)
+
+        with instrumentation.stage(method.__name__, inputs=args + tuple(kwargs.values())) as record:
+            result = method(self, *args, **kwargs)
+            # Tuples return a main frame plus derived ones (e.g. hexagons and centroids)
+            record['output_rows'] = _rows(result[:1] if isinstance(result, tuple) else (result,))
+        return result
+
+    return wrapper
+
+
+def instrument_public_methods(cls):
+    '''
+    Class decorator applying instrumented to every public method.
+    '''
+
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith('_') and name != 'instrument':
+            setattr(cls, name, instrumented(value))
+    return cls
+
+
+class JSONLogSink(object):
+    '''
+    Writes every record as a JSON line to a logger, or to a stream if no logger is given.
+
+    Parameters
+    ----------
+
+    logger: logging.Logger, optional
+    stream: file-like, optional
+            Default sys.stderr
+    '''
+
+    def __init__(self, logger=None, stream=None):
+        self.logger = logger
+        self.stream = stream
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        if self.logger is not None:
+            self.logger.info(line)
+        else:
+            print(line, file=self.stream or sys.stderr)
+
+
+class MetricsRegistry(object):
+    '''
+    In-process Prometheus-style registry aggregating the records by method.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = dict()
+
+    def emit(self, record):
+        with self._lock:
+            metrics = self.metrics.setdefault(record['method'], {
+                'calls_total': 0, 'seconds_sum': 0.0, 'seconds_max': 0.0, 'peak_bytes_max': 0,
+                'input_rows_total': 0, 'output_rows_total': 0, 'network_bytes_total': 0,
+            })
+            metrics['calls_total'] += 1
+            metrics['seconds_sum'] += record['seconds']
+            metrics['seconds_max'] = max(metrics['seconds_max'], record['seconds'])
+            metrics['peak_bytes_max'] = max(metrics['peak_bytes_max'], record['peak_bytes'] or 0)
+            metrics['input_rows_total'] += record['input_rows'] or 0
+            metrics['output_rows_total'] += record['output_rows'] or 0
+            metrics['network_bytes_total'] += record['network_bytes']
+
+    def exposition(self):
+        '''
+        Metrics in the Prometheus text exposition format.
+        '''
+
+        lines = list()
+        with self._lock:
+            names = sorted({name for metrics in self.metrics.values() for name in metrics})
+            for name in names:
+                lines.append(f'# TYPE hrud_method_{name} {"counter" if name.endswith(("total", "sum")) else "gauge"}')
+                for method, metrics in sorted(self.metrics.items()):
+                    lines.append(f'hrud_method_{name}{{method="{method}"}} {metrics[name]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _rows(values):
+    '''
+    Util function to count the rows of the DataFrames and arrays in values, including
+    the ones passed in lists (e.g. a list of GeoDataFrames).
+    '''
+
+    rows = 0
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            rows += sum(item.shape[0] for item in value if len(getattr(item, 'shape', ())) > 0)
+        elif len(getattr(value, 'shape', ())) > 0:
+            rows += value.shape[0]
+    return rows
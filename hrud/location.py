@@ -0,0 +1,197 @@
+import heapq
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from .facility_index import FacilityIndex
+from .accessibility import Accessibility
+
+
+class FacilityLocation(object):
+    '''
+    Greedy facility location over hexagon populations and candidate sites (e.g. parks
+    and pitches for temporary markets). A per hexagon best cost array holds the cost to
+    the closest open facility; when a site is added only the hexagons in its catchment
+    are updated. Gains only decrease as sites are added, so candidates are kept in a
+    lazy priority queue and only the top ones are reevaluated at each step.
+
+    Parameters
+    ----------
+
+    costs: sparse matrix (n_hexagons, n_candidates)
+           Cost from every hexagon to the candidates within max_cost, e.g.
+           Accessibility.costs
+
+    population: array_like
+                Demand of every hexagon
+
+    existing: array_like, optional
+              Cost from every hexagon to its closest existing facility
+
+    max_cost: float, optional
+              Catchment size. Hexagons farther than max_cost from every open facility
+              count as max_cost in the p-median objective
+
+    Example
+    -------
+
+    >> sjl_markets = gpd.read_file('inputs/flp_sjl/selected_facilities_sjl.shp').to_crs('EPSG:4326')
+    >> flp = FacilityLocation.from_points(sjl_hexs_centroids, sjl_hexs['population_2020'],
+                                         sjl_markets[sjl_markets['is_market'] == 0],
+                                         existing=sjl_markets[sjl_markets['is_market'] == 1],
+                                         max_cost=1.0)
+    >> sites, best = flp.max_coverage(10, radius=0.5)
+    >> sites.head(3)
+
+    site | gain    | covered
+    412  | 10528.3 | 184302.7
+    87   | 8121.9  | 192424.6
+    650  | 7764.0  | 200188.6
+
+    '''
+
+    def __init__(self, costs, population, existing=None, max_cost=None):
+        self.costs = sparse.csc_matrix(costs)
+        self.population = np.nan_to_num(np.asarray(population, dtype=np.float64))
+        self.max_cost = max_cost
+
+        n_hex = self.costs.shape[0]
+        self.existing = np.full(n_hex, np.inf) if existing is None else np.asarray(existing, dtype=np.float64)
+
+    @classmethod
+    def from_points(cls, centroids, population, candidates, existing=None, max_cost=1.0, n_jobs=1):
+        '''
+        Build the problem from hexagon centroids and candidate and existing facility
+        point GeoDataFrames in EPSG 4326, with haversine costs in km.
+        '''
+
+        costs = Accessibility.from_index(candidates, centroids, radius=max_cost, n_jobs=n_jobs).costs
+
+        existing_cost = None
+        if existing is not None and len(existing):
+            existing_cost = FacilityIndex.from_gdf(existing).query(centroids, n_jobs=n_jobs)[0][:, 0]
+
+        return cls(costs, population, existing=existing_cost, max_cost=max_cost)
+
+    def max_coverage(self, k, radius=None):
+        '''
+        Greedy maximal covering: add the k sites covering the most population not yet
+        within radius of an open facility.
+
+        Parameters
+        ----------
+
+        k: int
+           Number of sites to add. Fewer are returned when no site adds coverage
+
+        radius: float, optional
+                Coverage radius, at most max_cost. Default max_cost. ValueError is raised
+                when both are None or radius is larger than max_cost
+
+        Returns
+        -------
+
+        sites: DataFrame
+               Selected candidate positions in order, with the population they add (gain)
+               and the total covered population after adding them (covered)
+
+        best: ndarray
+              Cost from every hexagon to its closest facility after adding the sites
+        '''
+
+        radius = self.max_cost if radius is None else radius
+        if radius is None:
+            raise ValueError('max_coverage needs a coverage radius: pass radius or set max_cost')
+        if self.max_cost is not None and radius > self.max_cost:
+            raise ValueError(f'radius {radius} is larger than max_cost {self.max_cost}: costs are only '
+                             'stored within max_cost, build the problem with a larger max_cost')
+
+        best = self.existing.copy()
+        covered = best <= radius
+
+        def gain(site):
+            rows, costs = self._column(site)
+            return self.population[rows[(costs <= radius) & ~covered[rows]]].sum()
+
+        def add(site):
+            rows, costs = self._column(site)
+            np.minimum.at(best, rows, costs)
+            covered[rows[costs <= radius]] = True
+
+        sites = self._lazy_greedy(k, gain, add)
+        sites['covered'] = self.population[self.existing <= radius].sum() + sites['gain'].cumsum()
+
+        return sites, best
+
+    def p_median(self, k):
+        '''
+        Greedy p-median: add the k sites reducing the most the population weighted cost
+        to the closest facility. Needs max_cost unless every hexagon has an existing
+        facility, otherwise ValueError is raised.
+
+        Parameters
+        ----------
+
+        k: int
+           Number of sites to add. Fewer are returned when no site reduces the cost
+
+        Returns
+        -------
+
+        sites: DataFrame
+               Selected candidate positions in order, with the reduction of the weighted
+               cost (gain) and the mean cost per person after adding them (mean_cost)
+
+        best: ndarray
+              Cost from every hexagon to its closest facility after adding the sites
+        '''
+
+        best = self.existing.copy()
+        if self.max_cost is not None:
+            best = np.minimum(best, self.max_cost)
+        elif not np.isfinite(best).all():
+            raise ValueError('p_median needs max_cost when some hexagons have no existing facility, '
+                             'otherwise their cost is infinite and every gain is inf')
+
+        def gain(site):
+            rows, costs = self._column(site)
+            return (self.population[rows] * np.maximum(best[rows] - costs, 0)).sum()
+
+        def add(site):
+            rows, costs = self._column(site)
+            np.minimum.at(best, rows, costs)
+
+        total = self.population.sum()
+        weighted_cost = (self.population * best).sum()
+
+        sites = self._lazy_greedy(k, gain, add)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sites['mean_cost'] = (weighted_cost - sites['gain'].cumsum()) / total
+
+        return sites, best
+
+    def _column(self, site):
+        start, end = self.costs.indptr[site], self.costs.indptr[site + 1]
+        return self.costs.indices[start:end], self.costs.data[start:end]
+
+    def _lazy_greedy(self, k, gain, add):
+        '''
+        Util function for the greedy solvers. Gains stored in the heap are upper bounds,
+        a site is selected when its updated gain is still the largest.
+        '''
+
+        heap = [(-gain(site), site) for site in range(self.costs.shape[1])]
+        heapq.heapify(heap)
+
+        rows = list()
+        while heap and len(rows) < k:
+            _, site = heapq.heappop(heap)
+            current = gain(site)
+            if heap and current < -heap[0][0]:
+                heapq.heappush(heap, (-current, site))
+                continue
+            if current <= 0:
+                break
+            add(site)
+            rows.append((site, current))
+
+        return pd.DataFrame(rows, columns=['site', 'gain'])
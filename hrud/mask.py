@@ -0,0 +1,140 @@
+import numpy as np
+import shapely
+
+INSIDE, OUTSIDE, BOUNDARY = 1, 0, 2
+
+
+class PolygonMask(object):
+    '''
+    Point in polygon mask for many include and exclude polygons at once. The polygons are
+    indexed once on a regular lon/lat grid: every grid cell is classified as inside,
+    outside or crossed by a polygon boundary. Points are mapped to their cell with
+    arithmetic only, and just the points in boundary cells are tested exactly against
+    the prepared polygons.
+
+    Parameters
+    ----------
+
+    include: GeoDataFrame, GeoSeries, geometry or list of geometries
+             Polygons where points are kept (e.g. districts from download_osm)
+
+    exclude: GeoDataFrame, GeoSeries, geometry or list of geometries, optional
+             Polygons removed from the mask (e.g. San Lorenzo Island)
+
+    cell_size: float, optional
+               Grid cell size in degrees. Smaller cells leave fewer points for the exact
+               test but take longer to index. Default from max_cells
+
+    max_cells: int
+               Number of grid cells over the include bounds when cell_size is not given
+
+    include_edges: bool
+                   Keep the points on the boundary of the include polygons. Default False,
+                   only points strictly inside are kept
+
+    Example
+    -------
+
+    >> san_lorenzo = box(-77.2, -12.2, -77.17, -12.0)
+    >> mask = PolygonMask(lima, exclude=[san_lorenzo])
+    >> keep = mask.contains(pop_lima['latitude'].values, pop_lima['longitude'].values)
+    >> pop_lima[keep].shape
+    (348427, 4)
+
+    '''
+
+    def __init__(self, include, exclude=None, cell_size=None, max_cells=100000, include_edges=False):
+        self.include_edges = include_edges
+        self.include = shapely.union_all(_geometries(include))
+        self.exclude = shapely.union_all(_geometries(exclude)) if exclude is not None else None
+        shapely.prepare(self.include)
+        if self.exclude is not None:
+            shapely.prepare(self.exclude)
+
+        minx, miny, maxx, maxy = self.include.bounds
+        if cell_size is None:
+            cell_size = max(np.sqrt((maxx - minx) * (maxy - miny) / max_cells), 1e-5)
+        self.cell_size = cell_size
+        self.origin = (minx, miny)
+        self.shape = (max(int(np.ceil((maxx - minx) / cell_size)), 1),
+                      max(int(np.ceil((maxy - miny) / cell_size)), 1))
+
+        ix, iy = np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), indexing='ij')
+        ix, iy = ix.ravel(), iy.ravel()
+        cells = shapely.box(minx + ix * cell_size, miny + iy * cell_size,
+                            minx + (ix + 1) * cell_size, miny + (iy + 1) * cell_size)
+
+        inside = shapely.contains_properly(self.include, cells)
+        outside = ~shapely.intersects(self.include, cells)
+        if self.exclude is not None:
+            inside &= ~shapely.intersects(self.exclude, cells)
+            outside |= shapely.contains(self.exclude, cells)
+
+        grid = np.full(len(cells), BOUNDARY, dtype=np.int8)
+        grid[inside] = INSIDE
+        grid[outside] = OUTSIDE
+        self.grid = grid.reshape(self.shape)
+
+    def contains(self, lat, lon=None):
+        '''
+        Boolean mask of the points inside the include polygons and outside the exclude
+        polygons.
+
+        Parameters
+        ----------
+
+        lat: array_like or DataFrame
+             Latitudes, a DataFrame with latitude and longitude columns (e.g. from
+             download_hdx) or a point GeoDataFrame
+
+        lon: array_like
+             Longitudes. Not needed when lat is a DataFrame
+        '''
+
+        lat, lon = _coordinates(lat, lon)
+
+        x = np.floor((lon - self.origin[0]) / self.cell_size)
+        y = np.floor((lat - self.origin[1]) / self.cell_size)
+        in_grid = (x >= 0) & (x < self.shape[0]) & (y >= 0) & (y < self.shape[1])
+
+        classes = np.full(len(lat), OUTSIDE, dtype=np.int8)
+        classes[in_grid] = self.grid[x[in_grid].astype(np.int64), y[in_grid].astype(np.int64)]
+
+        mask = classes == INSIDE
+        boundary = np.flatnonzero(classes == BOUNDARY)
+
+        test_xy = shapely.intersects_xy if self.include_edges else shapely.contains_xy
+        exact = test_xy(self.include, lon[boundary], lat[boundary])
+        if self.exclude is not None:
+            exact &= ~shapely.intersects_xy(self.exclude, lon[boundary], lat[boundary])
+        mask[boundary] = exact
+
+        return mask
+
+    def __call__(self, lat, lon=None):
+        return self.contains(lat, lon)
+
+
+def _geometries(geoms):
+    '''
+    Util function to get a geometry array from a GeoDataFrame, GeoSeries, list or geometry.
+    '''
+
+    if hasattr(geoms, 'geometry'):
+        return geoms.geometry.values.data
+    if isinstance(geoms, shapely.Geometry):
+        return np.array([geoms])
+    return np.asarray(list(geoms), dtype=object)
+
+
+def _coordinates(lat, lon):
+    '''
+    Util function to get float64 lat, lon arrays from arrays, a DataFrame or a GeoDataFrame.
+    '''
+
+    if lon is None:
+        if hasattr(lat, 'geometry'):
+            return lat.geometry.y.values.astype(np.float64), lat.geometry.x.values.astype(np.float64)
+        return lat['latitude'].values.astype(np.float64), lat['longitude'].values.astype(np.float64)
+
+    return np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
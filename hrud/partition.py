@@ -0,0 +1,385 @@
+'''
+Partitioned execution of the HRUD indicators for areas too large to hold in memory
+(e.g. all of Peru at resolution 8 or 9).
+
+The area is sharded by coarse H3 parent cells. Population points are streamed once from
+the CSV, filtered to the area bounds and its shards and spilled with their hexagon index
+to one Parquet directory per shard. Every shard is then aggregated by hexagon (as
+merge_shape_hex method='h3') and gets its nearest facility search in a process pool. The
+facilities of the neighbouring shards (the halo) are included in the search, so hexagons
+near shard borders still find their nearest facility. Peak memory is bounded by the
+largest shard, not by the area.
+
+Results are written as a Parquet dataset partitioned by shard, which can be read back
+with pd.read_parquet(output_dir) or filtered by shard with pyarrow.
+
+Usage
+-----
+
+    python -m hrud.partition config.json
+
+Config example
+--------------
+
+    {
+        "output_dir": "outputs/peru_9",
+        "boundary": "inputs/peru/peru.shp",
+        "population": "inputs/population_per_2018-10-01.csv.zip",
+        "population_columns": ["population_2020"],
+        "facilities": {"food_supply": "inputs/peru/markets.shp"},
+        "resolution": 9,
+        "shard_resolution": 4,
+        "halo": 1,
+        "workers": 4
+    }
+
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from h3 import h3
+from concurrent.futures import ProcessPoolExecutor
+from .hrud import HRUD, h3_vect, _h3_to_int, _int_to_h3
+from .facility_index import FacilityIndex
+
+# Estado de cada proceso, inicializado una vez por worker
+_WORKER = dict()
+
+
+def shard_cells(area, shard_resolution):
+    '''
+    H3 cells at shard_resolution covering the area: the polyfill of the area plus the
+    cells crossed by its boundary.
+
+    Parameters
+    ----------
+
+    area: GeoDataFrame
+          Study area polygons in EPSG 4326
+
+    shard_resolution: int
+                      Resolution of the shard cells (e.g. 4, about 1770 km2 per shard)
+
+    Returns
+    -------
+
+    shards: list
+            Sorted H3 indexes of the shards
+    '''
+
+    hrud = HRUD()
+    shards = set(hrud._polyfill_city(shard_resolution, area, 1))
+
+    # Boundary densified to a fraction of the shard edge, so every crossed cell gets a vertex
+    step = h3.edge_length(shard_resolution, 'km') / 111.32 / 4
+    boundary = shapely.segmentize(shapely.boundary(area.geometry.values.data), step)
+    coords = shapely.get_coordinates(boundary)
+    cells = h3_vect.geo_to_h3(np.ascontiguousarray(coords[:, 1]), np.ascontiguousarray(coords[:, 0]),
+                              shard_resolution)
+    shards.update(_int_to_h3(np.unique(cells)))
+
+    return sorted(shards)
+
+
+def spill_points(population, resolution, shard_resolution, spill_dir, columns, chunksize=500000,
+                 shards=None, bounds=None):
+    '''
+    Stream population points and write them to one Parquet directory per shard
+    (spill_dir/shard=<h3>/part-<chunk>.parquet), with the uint64 H3 index of their
+    hexagon in the 'hex' column.
+
+    Parameters
+    ----------
+
+    population: str or iterable
+                HDX CSV path or URL, or an iterable of DataFrame chunks with latitude,
+                longitude and the population columns
+
+    resolution: int
+                Hexagon resolution. Points go to the shard of their hexagon, which is not
+                always the shard cell containing the point
+
+    shard_resolution: int
+
+    spill_dir: str
+
+    columns: list
+             Population columns to keep
+
+    chunksize: int
+               Number of CSV rows read per chunk
+
+    shards: list, optional
+            Shards to keep (see shard_cells). Points of other shards are not written
+
+    bounds: tuple, optional
+            (minx, miny, maxx, maxy) of the area. Points outside are dropped, as in
+            filter_population
+
+    Returns
+    -------
+
+    counts: Series
+            Number of points per shard
+    '''
+
+    if isinstance(population, str):
+        dtypes = {column: np.float32 for column in columns}
+        population = pd.read_csv(population, chunksize=chunksize, dtype=dtypes,
+                                 usecols=['latitude', 'longitude'] + list(columns))
+
+    shards = None if shards is None else _h3_to_int(shards)
+
+    counts = dict()
+    for i, chunk in enumerate(population):
+        # Coordenadas en float64, como en filter_population y merge_shape_hex
+        lat = np.ascontiguousarray(chunk['latitude'].values, dtype=np.float64)
+        lon = np.ascontiguousarray(chunk['longitude'].values, dtype=np.float64)
+
+        keep = np.ones(len(lat), dtype=bool)
+        if bounds is not None:
+            minx, miny, maxx, maxy = bounds
+            keep = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+
+        cells = h3_vect.geo_to_h3(lat[keep], lon[keep], resolution)
+        parents = h3_vect.h3_to_parent(cells, shard_resolution)
+
+        chunk = pd.DataFrame({'hex': cells}).join(chunk.loc[keep, list(columns)].reset_index(drop=True))
+        if shards is not None:
+            in_area = np.isin(parents, shards)
+            chunk, parents = chunk[in_area], parents[in_area]
+
+        for parent, rows in pd.Series(np.arange(len(parents))).groupby(parents):
+            shard = format(int(parent), 'x')
+            path = os.path.join(spill_dir, f'shard={shard}')
+            os.makedirs(path, exist_ok=True)
+            chunk.iloc[rows.values].to_parquet(os.path.join(path, f'part-{i}.parquet'), index=False)
+            counts[shard] = counts.get(shard, 0) + len(rows)
+
+    return pd.Series(counts, dtype=np.int64)
+
+
+def run_partitioned(area, population, output_dir, facilities=None, resolution=9, shard_resolution=4,
+                    halo=1, workers=1, population_columns=('population_2020',), chunksize=500000):
+    '''
+    Compute the hexagon population and the distance to the nearest facility of every
+    facility set for a large area, shard by shard.
+
+    Parameters
+    ----------
+
+    area: GeoDataFrame
+          Study area polygons in EPSG 4326
+
+    population: str or iterable
+                HDX CSV path or URL, or an iterable of DataFrame chunks (see spill_points)
+
+    output_dir: str
+                Output Parquet dataset directory
+
+    facilities: dict, optional
+                Facility set name as keys and point GeoDataFrames in EPSG 4326 as values
+                (e.g. {'food_supply': markets})
+
+    resolution: int
+                Hexagon resolution
+
+    shard_resolution: int
+                      Resolution of the shard cells
+
+    halo: int
+          Rings of neighbouring shards whose facilities are included in the search.
+          Hexagons whose nearest facility is farther than the halo are searched again
+          against all facilities.
+
+    workers: int
+             Number of worker processes
+
+    population_columns: list
+                        Population columns aggregated by sum
+
+    chunksize: int
+               Number of CSV rows read per chunk
+
+    Returns
+    -------
+
+    summary: DataFrame
+             Hexagons, population points and seconds per shard
+
+    Example
+    -------
+
+    >> peru = download_osm(0, 'Peru')
+    >> summary = run_partitioned(peru, 'population_per_2018-10-01.csv.zip', 'outputs/peru_9',
+                                 facilities={'food_supply': markets}, workers=4)
+    >> peru_hex = pd.read_parquet('outputs/peru_9')
+
+    hex             | population_2020 | dist_food_supply | shard
+    898e62c8003ffff | 412.3           | 0.83             | 848e62dffffffff
+
+    '''
+
+    facilities = facilities or dict()
+    population_columns = list(population_columns)
+    shards = shard_cells(area, shard_resolution)
+
+    spill_dir = os.path.join(output_dir, '_spill')
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    points = spill_points(population, resolution, shard_resolution, spill_dir, population_columns, chunksize,
+                          shards=shards, bounds=area.geometry.total_bounds)
+
+    facility_sets = dict()
+    for name, gdf in facilities.items():
+        lat = np.ascontiguousarray(gdf.geometry.y.values, dtype=np.float64)
+        lon = np.ascontiguousarray(gdf.geometry.x.values, dtype=np.float64)
+        parents = _int_to_h3(h3_vect.geo_to_h3(lat, lon, shard_resolution)) if len(gdf) else np.array([], dtype=object)
+        facility_sets[name] = (lat, lon, parents)
+
+    config = {
+        'area': area.geometry.unary_union, 'output_dir': output_dir, 'spill_dir': spill_dir,
+        'resolution': resolution, 'shard_resolution': shard_resolution, 'halo': halo,
+        'population_columns': population_columns, 'facilities': facility_sets,
+    }
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config,)) as executor:
+            rows = list(executor.map(run_shard, shards))
+    else:
+        _init_worker(config)
+        rows = [run_shard(shard) for shard in shards]
+
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    summary = pd.DataFrame(rows, columns=['shard', 'hexagons', 'seconds'])
+    summary['points'] = points.reindex(summary['shard']).fillna(0).astype(np.int64).values
+    return summary
+
+
+def _init_worker(config):
+    '''
+    Util function to keep the area and facilities in every worker process, so they are
+    sent once per worker instead of once per shard.
+    '''
+
+    shapely.prepare(config['area'])
+    _WORKER.clear()
+    _WORKER.update(config)
+    _WORKER['indexes'] = dict()
+
+
+def run_shard(shard):
+    '''
+    Run every stage for a single shard and write its partition. Called in the worker
+    processes after _init_worker.
+
+    Returns
+    -------
+
+    shard: str
+    hexagons: int
+              Number of hexagons written
+    seconds: float
+    '''
+
+    start = time.time()
+    config = _WORKER
+
+    # Hexágonos del shard: hijos cuyo centroide está dentro del área (como el polyfill)
+    children = np.array(sorted(h3.h3_to_children(shard, config['resolution'])), dtype=object)
+    centroids = np.array([h3.h3_to_geo(child) for child in children]).reshape(-1, 2)
+    inside = shapely.contains_xy(config['area'], centroids[:, 1], centroids[:, 0])
+    children, centroids = children[inside], centroids[inside]
+    if len(children) == 0:
+        return shard, 0, time.time() - start
+
+    columns = config['population_columns']
+    result = pd.DataFrame({'hex': children})
+
+    # Los puntos ya tienen su hexágono: se agregan igual que merge_shape_hex method='h3'
+    shard_dir = os.path.join(config['spill_dir'], f'shard={shard}')
+    if os.path.exists(shard_dir):
+        points = pd.read_parquet(shard_dir)
+        hex_pop = points[columns].groupby(points['hex'].values, sort=False).sum()
+        hex_pop = hex_pop.reindex(_h3_to_int(children))
+    else:
+        hex_pop = pd.DataFrame(np.nan, index=np.arange(len(children)), columns=columns)
+
+    for column in columns:
+        result[column] = hex_pop[column].values.astype(np.float32)
+
+    for name in config['facilities']:
+        result[f'dist_{name}'] = _nearest_distance(name, shard, centroids).astype(np.float32)
+
+    path = os.path.join(config['output_dir'], f'shard={shard}')
+    os.makedirs(path, exist_ok=True)
+    result.to_parquet(os.path.join(path, 'part-0.parquet'), index=False)
+
+    return shard, len(result), time.time() - start
+
+
+def _nearest_distance(name, shard, centroids):
+    '''
+    Util function to search the nearest facility of a set for the hexagon centroids of
+    a shard, among the facilities of the shard and its halo.
+    '''
+
+    config = _WORKER
+    lat, lon, parents = config['facilities'][name]
+    if len(lat) == 0:
+        return np.full(len(centroids), np.nan)
+
+    halo = config['halo']
+    nearby = np.isin(parents, list(h3.k_ring(shard, halo)))
+
+    distances = np.full(len(centroids), np.inf)
+    if nearby.any():
+        distances = FacilityIndex(lat[nearby], lon[nearby]).query(centroids[:, 0], centroids[:, 1])[0][:, 0]
+
+    # Más lejos que el halo puede haber una instalación más cercana fuera de él
+    guaranteed = halo * h3.edge_length(config['shard_resolution'], 'km')
+    far = distances > guaranteed
+    if far.any():
+        if name not in config['indexes']:
+            config['indexes'][name] = FacilityIndex(lat, lon)
+        distances[far] = config['indexes'][name].query(centroids[far, 0], centroids[far, 1])[0][:, 0]
+
+    return distances
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the HRUD indicators for a large area by shards')
+    parser.add_argument('config', help='JSON config file with boundary, population and facilities')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    area = gpd.read_file(config['boundary']).to_crs('EPSG:4326')
+    facilities = {name: gpd.read_file(path).to_crs('EPSG:4326')
+                  for name, path in config.get('facilities', {}).items()}
+
+    summary = run_partitioned(
+        area, config['population'], config['output_dir'], facilities=facilities,
+        resolution=config.get('resolution', 9), shard_resolution=config.get('shard_resolution', 4),
+        halo=config.get('halo', 1), workers=args.workers or config.get('workers', 1),
+        population_columns=config.get('population_columns', ['population_2020']),
+    )
+
+    print(summary.to_string(index=False))
+    print(f"{summary['hexagons'].sum()} hexagons in {len(summary)} shards, "
+          f"{summary['seconds'].sum():.1f}s of shard time")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
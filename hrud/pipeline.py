@@ -0,0 +1,247 @@
+'''
+Batch runner for the HRUD indicators over several cities or districts.
+
+Every area goes through download_osm -> population -> gen_hexagons -> merge_shape_hex ->
+access metrics, with each stage checkpointed to GeoParquet so a crashed or changed run
+resumes from the last good stage. Areas are processed in a process pool. Access metrics
+are the distance to the nearest facility for each point indicator ('food_supply',
+'healthcare_facilities').
+
+Usage
+-----
+
+    python -m hrud.pipeline config.json
+
+Config example
+--------------
+
+    {
+        "output_dir": "outputs/pipeline",
+        "cache_dir": "cache",
+        "hdx_resource": "4e74db39-87f1-4383-9255-eaf8ebceb0c9/resource/317f1c39-8417-4bde-a076-99bd37feefce/download/population_per_2018-10-01.csv.zip",
+        "population_column": "population_2020",
+        "workers": 4,
+        "resolutions": [8, 9],
+        "indicators": ["food_supply", "healthcare_facilities"],
+        "areas": [
+            {"name": "sjl", "osm": [["San Juan de Lurigancho, Lima", 0]]},
+            {"name": "lima", "osm": [["Lima, Peru", 2], ["Callao, Peru", 1]], "resolutions": [8]}
+        ]
+    }
+
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from h3 import h3
+from concurrent.futures import ProcessPoolExecutor
+from .hrud import HRUD
+from .facility_index import FacilityIndex
+
+
+class Checkpoints(object):
+    '''
+    Stage outputs of an area stored as GeoParquet, with a manifest holding the hash of
+    the parameters each output was computed with.
+
+    Parameters
+    ----------
+
+    path: str
+          Output directory of the area
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.manifest = dict()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def run(self, stage, params, compute, timings):
+        '''
+        Load the stage output if it was computed with the same params, otherwise compute
+        and save it.
+
+        Parameters
+        ----------
+
+        stage: str
+               Stage name, used as file name
+
+        params: dict
+                Everything the output depends on, including the hashes of the upstream stages
+
+        compute: callable
+                 Function without arguments returning a GeoDataFrame
+
+        timings: dict
+                 Stage wall times in seconds are added here
+
+        Returns
+        -------
+
+        gdf: GeoDataFrame
+        stage_hash: str
+                    Hash identifying this output, to be passed to downstream stages
+        '''
+
+        stage_hash = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        file_path = os.path.join(self.path, f'{stage}.parquet')
+
+        start = time.time()
+        if self.manifest.get(stage) == stage_hash and os.path.exists(file_path):
+            gdf = _restore_columns(gpd.read_parquet(file_path))
+            timings[stage] = ('cached', time.time() - start)
+            return gdf, stage_hash
+
+        gdf = compute()
+        tmp_path = f'{file_path}.tmp'
+        gdf.rename(columns=str).to_parquet(tmp_path)
+        os.replace(tmp_path, file_path)
+
+        self.manifest[stage] = stage_hash
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+        timings[stage] = ('run', time.time() - start)
+        return gdf, stage_hash
+
+
+def run_area(area, config):
+    '''
+    Run every stage for a single area.
+
+    Parameters
+    ----------
+
+    area: dict
+          Area config with name, osm list of [query, expected_position] and optionally
+          resolutions and indicators overriding the global ones
+
+    config: dict
+            Global config
+
+    Returns
+    -------
+
+    name: str
+    timings: dict
+             stage -> (status, seconds)
+    '''
+
+    hrud = HRUD(cache_dir=config.get('cache_dir'))
+    checkpoints = Checkpoints(os.path.join(config['output_dir'], area['name']))
+    resolutions = area.get('resolutions', config.get('resolutions', [9]))
+    indicators = area.get('indicators', config.get('indicators', []))
+    population_column = config.get('population_column', 'population_2020')
+    timings = dict()
+
+    def boundary():
+        gdfs = [hrud.download_osm(position, query) for query, position in area['osm']]
+        return hrud.merge_geom_downloads(gdfs).set_crs('EPSG:4326', allow_override=True)
+
+    city, city_hash = checkpoints.run('boundary', {'osm': area['osm']}, boundary, timings)
+
+    population, population_hash = checkpoints.run(
+        'population', {'boundary': city_hash, 'resource': config['hdx_resource']},
+        lambda: hrud.stream_hdx(config['hdx_resource'], city), timings)
+
+    pois = dict()
+    for est_type in indicators:
+        pois[est_type] = checkpoints.run(
+            f'poi_{est_type}', {'boundary': city_hash, 'est_type': est_type},
+            lambda: hrud.download_overpass_poi(city.total_bounds, est_type).set_crs('EPSG:4326'),
+            timings)
+
+    for resolution in resolutions:
+        hexagons, hexagons_hash = checkpoints.run(
+            f'hexagons_{resolution}', {'boundary': city_hash, 'resolution': resolution},
+            lambda: hrud.gen_hexagons(resolution, city)[0], timings)
+
+        hex_pop, hex_pop_hash = checkpoints.run(
+            f'population_{resolution}', {'hexagons': hexagons_hash, 'population': population_hash,
+                                         'column': population_column},
+            lambda: hrud.merge_shape_hex(hexagons, population, 'inner', 'within',
+                                         {population_column: 'sum'}, method='h3'),
+            timings)
+
+        def access():
+            hex_access = hex_pop.copy()
+            centroids = np.array([h3.h3_to_geo(hexagon) for hexagon in hex_access[0]]).reshape(-1, 2)
+            for est_type, (poi, _) in pois.items():
+                if len(poi) == 0:
+                    hex_access[f'dist_{est_type}'] = np.nan
+                    continue
+                distances, _ = FacilityIndex.from_gdf(poi).query(centroids[:, 0], centroids[:, 1])
+                hex_access[f'dist_{est_type}'] = distances[:, 0]
+            return hex_access
+
+        poi_hashes = {est_type: poi_hash for est_type, (_, poi_hash) in pois.items()}
+        checkpoints.run(f'access_{resolution}', {'population': hex_pop_hash, 'pois': poi_hashes},
+                        access, timings)
+
+    return area['name'], timings
+
+
+def print_summary(results):
+    '''
+    Print the per area timing summary.
+    '''
+
+    rows = list()
+    for name, timings in results:
+        for stage, (status, seconds) in timings.items():
+            rows.append({'area': name, 'stage': stage, 'status': status, 'seconds': round(seconds, 2)})
+        rows.append({'area': name, 'stage': 'total', 'status': '',
+                     'seconds': round(sum(seconds for _, seconds in timings.values()), 2)})
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the HRUD indicators for several areas')
+    parser.add_argument('config', help='JSON config file listing areas, resolutions and indicators')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    workers = args.workers or config.get('workers', 1)
+    areas = config['areas']
+
+    results = list()
+    failed = list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {area['name']: executor.submit(run_area, area, config) for area in areas}
+        for name, future in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as err:
+                print(f'{name} failed: {err!r}', file=sys.stderr)
+                failed.append(name)
+
+    print_summary(results)
+
+    return 1 if failed else 0
+
+
+def _restore_columns(gdf):
+    '''
+    Parquet needs string column names: restore the gen_hexagons hex id column name.
+    '''
+
+    return gdf.rename(columns={'0': 0})
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from .hrud import h3_vect, _h3_to_int, _int_to_h3, _hex_geometries, _aggregate_points
+
+
+class HexPyramid(object):
+    '''
+    Multi-resolution H3 aggregates. Indicators are aggregated once at the finest
+    resolution and coarser levels are derived by rolling children up to their parents.
+    Sums and counts add up, means are weighted (e.g. by population).
+
+    Parameters
+    ----------
+
+    fine: DataFrame
+          Indicators at the finest resolution, indexed by uint64 H3 index
+
+    resolution: int
+                Finest resolution
+
+    resolutions: list
+                 Coarser resolutions to derive (e.g. [7, 8])
+
+    sums: list
+          Columns aggregated by sum. Counts are sums of counts, so they also go here
+
+    means: dict
+           Columns aggregated by weighted mean, with the weight column as value
+           (e.g. {'dist_nn_market': 'population_2020'})
+
+    Example
+    -------
+
+    >> pyramid = HexPyramid.from_hex(lima_hex_pop, 9, [7, 8], sums=['population_2020'],
+                                     means={'dist_nn_market': 'population_2020'})
+    >> pyramid.to_gdf(7).head()
+        0               | population_2020 | dist_nn_market | geometry
+        878e62d34ffffff | 25391.2         | 0.83           | POLYGON ((-77.0...
+
+    '''
+
+    def __init__(self, fine, resolution, resolutions, sums=(), means=None):
+        self.resolution = resolution
+        self.resolutions = sorted(set(resolutions) - {resolution}, reverse=True)
+        self.sums = list(sums)
+        self.means = dict() if means is None else dict(means)
+
+        self.levels = {resolution: fine}
+        self._sum_frames = dict()
+
+        sum_frame = self._to_sums(fine)
+        cells = fine.index.values.astype(np.uint64)
+        for res in self.resolutions:
+            self._sum_frames[res] = sum_frame.groupby(h3_vect.h3_to_parent(cells, res), sort=False).sum()
+            self.levels[res] = self._from_sums(self._sum_frames[res])
+
+    @classmethod
+    def from_hex(cls, hex, resolution, resolutions, sums=(), means=None, hex_col=0):
+        '''
+        Build a pyramid from a hexagon GeoDataFrame at the finest resolution, e.g. the output
+        of merge_shape_hex.
+        '''
+
+        columns = list(sums) + list((means or {}).keys())
+        columns += [weight for weight in (means or {}).values() if weight not in columns]
+        fine = pd.DataFrame(hex[columns].values, columns=columns, index=_h3_to_int(hex[hex_col].values))
+
+        return cls(fine.astype(np.float64), resolution, resolutions, sums, means)
+
+    @classmethod
+    def from_points(cls, points, resolution, resolutions, agg, means=None):
+        '''
+        Build a pyramid from a point GeoDataFrame, aggregating at the finest resolution by H3
+        index (see merge_shape_hex method='h3').
+
+        agg: dict. Columns to aggregate at the finest resolution as keys and one of
+             {'sum', 'count'} as values.
+        '''
+
+        fine = _aggregate_points(points, resolution, agg, np.float64)
+
+        return cls(fine, resolution, resolutions, sums=list(agg.keys()), means=means)
+
+    def level(self, resolution):
+        '''
+        Indicators at a resolution, indexed by uint64 H3 index.
+        '''
+
+        return self.levels[resolution]
+
+    def to_gdf(self, resolution):
+        '''
+        Indicators at a resolution as a hexagon GeoDataFrame in the gen_hexagons format.
+        '''
+
+        level = self.levels[resolution]
+        h3_indexes = _int_to_h3(level.index.values)
+        polygons, _ = _hex_geometries(h3_indexes)
+
+        gdf = gpd.GeoDataFrame(level.reset_index(drop=True), geometry=polygons, crs='EPSG:4326')
+        gdf.insert(0, 0, h3_indexes)
+
+        return gdf
+
+    def update(self, fine):
+        '''
+        Update some cells at the finest resolution. Coarser levels keep their additive
+        sums, so only the changes of the updated cells are rolled up to their ancestors.
+
+        Parameters
+        ----------
+
+        fine: DataFrame
+              New indicator values, indexed by uint64 H3 index at the finest resolution.
+              Cells not in the pyramid are added.
+        '''
+
+        base = self.levels[self.resolution]
+        fine = fine[base.columns].astype(np.float64)
+        fine = fine[~fine.index.duplicated(keep='last')]
+
+        old = base.reindex(fine.index)
+        delta = self._to_sums(fine) - self._to_sums(old).fillna(0)
+
+        new_cells = fine.index.difference(base.index)
+        if len(new_cells):
+            base = pd.concat([base, fine.loc[new_cells]])
+        base.loc[fine.index, base.columns] = fine.values
+        self.levels[self.resolution] = base
+
+        changed = fine.index.values.astype(np.uint64)
+        for res in self.resolutions:
+            rolled = delta.groupby(h3_vect.h3_to_parent(changed, res), sort=False).sum()
+
+            sum_frame = self._sum_frames[res]
+            added = rolled.index.difference(sum_frame.index)
+            if len(added):
+                sum_frame = pd.concat([sum_frame, pd.DataFrame(0.0, index=added, columns=sum_frame.columns)])
+            sum_frame.loc[rolled.index] += rolled.values
+            self._sum_frames[res] = sum_frame
+
+            level = self.levels[res]
+            if len(added):
+                level = level.reindex(level.index.append(added))
+            level.loc[rolled.index, level.columns] = self._from_sums(sum_frame.loc[rolled.index])[level.columns].values
+            self.levels[res] = level
+
+    def _to_sums(self, base):
+        '''
+        Additive form of a level: means are stored as weighted sums, with the weight only
+        where the mean column is known.
+        '''
+
+        sum_frame = base[self.sums].fillna(0)
+        for column, weight in self.means.items():
+            known = base[weight].where(base[column].notna())
+            sum_frame[f'_w_{column}'] = known.fillna(0).values
+            sum_frame[f'_wx_{column}'] = (base[column] * known).fillna(0).values
+            if weight not in self.sums:
+                sum_frame[f'_s_{weight}'] = base[weight].fillna(0).values
+
+        return sum_frame
+
+    def _from_sums(self, grouped):
+        level = grouped[self.sums].copy()
+        for column, weight in self.means.items():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                level[column] = grouped[f'_wx_{column}'] / grouped[f'_w_{column}']
+            if weight not in self.sums:
+                level[weight] = grouped[f'_s_{weight}']
+
+        return level
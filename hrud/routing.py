@@ -0,0 +1,265 @@
+import time
+import numpy as np
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from .facility_index import FacilityIndex
+
+
+class OSRMClient(object):
+    '''
+    Batched many-to-many client for the OSRM table service. Origins and destinations
+    are split into chunks that fit the server's table size limit, requested concurrently
+    over a pooled session, retried on failure and cached by origin, destination and profile.
+
+    Parameters
+    ----------
+
+    base_url: str
+              OSRM server url. Default is a local server.
+
+    profile: str
+             Default routing profile (e.g. 'walking', 'driving')
+
+    max_table_size: int
+                    Maximum number of coordinates per request. Must not exceed the
+                    server's --max-table-size (100 by default)
+
+    max_workers: int
+                 Maximum number of concurrent requests
+
+    retries: int
+             Number of retries for each failed request
+
+    backoff: float
+             Seconds to wait before the first retry. Doubles on every retry.
+
+    timeout: float
+             Timeout in seconds for each request
+
+    cache: MutableMapping, optional
+           Mapping used to cache (distance, duration) by origin, destination and profile.
+           A shelve can be passed to persist it. Default is an in-memory dict.
+
+    Example
+    -------
+
+    >> osrm = OSRMClient(profile='walking')
+    >> distances, durations = osrm.table(sjl_hexs_centroids, sjl_old_markets)
+    >> nearest = osrm.nearest(sjl_hexs_centroids, sjl_old_markets, k=3)
+    >> nearest.head()
+        facility | distance | duration
+        12       | 1534.2   | 1102.5
+        12       | 1720.9   | 1237.1
+
+    '''
+
+    def __init__(self, base_url='http://localhost:5000', profile='walking', max_table_size=100,
+                 max_workers=4, retries=3, backoff=0.5, timeout=60, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.profile = profile
+        self.max_table_size = max_table_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = dict() if cache is None else cache
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def table(self, origins, destinations, profile=None):
+        '''
+        Distance and duration matrices between every origin and destination.
+
+        Parameters
+        ----------
+
+        origins: GeoDataFrame or array_like (n, 2)
+                 Origin points (e.g. hexagon centroids from gen_hexagons) or lon, lat array
+
+        destinations: GeoDataFrame or array_like (m, 2)
+                      Destination points or lon, lat array
+
+        profile: str, optional
+                 Routing profile. Defaults to the client profile
+
+        Returns
+        -------
+
+        distances: ndarray (n, m)
+                   Route distance in meters. NaN when there is no route
+
+        durations: ndarray (n, m)
+                   Route duration in seconds. NaN when there is no route
+
+        '''
+
+        profile = self.profile if profile is None else profile
+        origins = _lonlat(origins)
+        destinations = _lonlat(destinations)
+
+        distances = np.full((len(origins), len(destinations)), np.nan)
+        durations = np.full((len(origins), len(destinations)), np.nan)
+
+        # Split the matrix into blocks that fit in a single request
+        block = max(self.max_table_size // 2, 1)
+        blocks = [(np.arange(i, min(i + block, len(origins))), np.arange(j, min(j + block, len(destinations))))
+                  for i in range(0, len(origins), block) for j in range(0, len(destinations), block)]
+
+        self._fill(profile, origins, destinations, blocks, distances, durations)
+
+        return distances, durations
+
+    def nearest(self, origins, destinations, k=3, profile=None):
+        '''
+        Travel time to the nearest destination for every origin. Routes are only requested
+        to the k nearest destinations by haversine distance.
+
+        Parameters
+        ----------
+
+        origins: GeoDataFrame or array_like (n, 2)
+                 Origin points (e.g. hexagon centroids from gen_hexagons) or lon, lat array
+
+        destinations: GeoDataFrame or array_like (m, 2)
+                      Destination points (e.g. markets) or lon, lat array
+
+        k: int
+           Number of candidate destinations routed per origin
+
+        profile: str, optional
+                 Routing profile. Defaults to the client profile
+
+        Returns
+        -------
+
+        nearest: DataFrame
+                 facility (positional index in destinations), distance (m) and duration (s)
+                 for each origin, aligned with the origins index when a GeoDataFrame is given
+
+        '''
+
+        profile = self.profile if profile is None else profile
+        index = origins.index if hasattr(origins, 'index') else None
+        origins = _lonlat(origins)
+        destinations = _lonlat(destinations)
+
+        k = min(k, len(destinations))
+        facility_index = FacilityIndex(destinations[:, 1], destinations[:, 0])
+        _, candidates = facility_index.query(origins[:, 1], origins[:, 0], k=k)
+
+        # Origins are chunked so that the union of their candidates fits in a request
+        distances = np.full(candidates.shape, np.nan)
+        durations = np.full(candidates.shape, np.nan)
+        chunk = max(self.max_table_size // (k + 1), 1)
+
+        blocks = list()
+        for i in range(0, len(origins), chunk):
+            rows = np.arange(i, min(i + chunk, len(origins)))
+            blocks.append((rows, np.unique(candidates[rows])))
+
+        block_distances = dict()
+        block_durations = dict()
+        full_distances = _BlockMatrix(block_distances)
+        full_durations = _BlockMatrix(block_durations)
+        self._fill(profile, origins, destinations, blocks, full_distances, full_durations)
+
+        for rows, cols in blocks:
+            for r in rows:
+                distances[r] = [block_distances[(r, c)] for c in candidates[r]]
+                durations[r] = [block_durations[(r, c)] for c in candidates[r]]
+
+        # Unreachable candidates never win
+        best = np.argmin(np.where(np.isnan(durations), np.inf, durations), axis=1)
+        rows = np.arange(len(origins))
+
+        return pd.DataFrame({
+            'facility': candidates[rows, best],
+            'distance': distances[rows, best],
+            'duration': durations[rows, best],
+        }, index=index)
+
+    def _fill(self, profile, origins, destinations, blocks, distances, durations):
+        '''
+        Fill the distance and duration matrices for every block, requesting only the
+        blocks that are not fully cached.
+        '''
+
+        keys = lambda rows, cols: [[self._key(profile, origins[r], destinations[c]) for c in cols] for r in rows]
+
+        missing = list()
+        for rows, cols in blocks:
+            block_keys = keys(rows, cols)
+            if all(key in self.cache for row in block_keys for key in row):
+                for r, row in zip(rows, block_keys):
+                    for c, key in zip(cols, row):
+                        distances[r, c], durations[r, c] = self.cache[key]
+            else:
+                missing.append((rows, cols))
+
+        request = lambda block: self._request(profile, origins[block[0]], destinations[block[1]])
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(request, missing))
+
+        for (rows, cols), (block_distances, block_durations) in zip(missing, results):
+            for i, r in enumerate(rows):
+                for j, c in enumerate(cols):
+                    distances[r, c] = block_distances[i, j]
+                    durations[r, c] = block_durations[i, j]
+                    self.cache[self._key(profile, origins[r], destinations[c])] = (block_distances[i, j],
+                                                                                 block_durations[i, j])
+
+    def _request(self, profile, origins, destinations):
+        coords = ';'.join(f'{lon:.6f},{lat:.6f}' for lon, lat in np.vstack([origins, destinations]))
+        sources = ';'.join(map(str, range(len(origins))))
+        targets = ';'.join(map(str, range(len(origins), len(origins) + len(destinations))))
+
+        # Query built by hand: OSRM expects unescaped ';' separators
+        url = (f'{self.base_url}/table/v1/{profile}/{coords}'
+               f'?sources={sources}&destinations={targets}&annotations=distance,duration')
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                data = response.json()
+                break
+            except (requests.RequestException, ValueError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+        if data.get('code') != 'Ok':
+            raise ValueError(f"OSRM error {data.get('code')}: {data.get('message')}")
+
+        return (np.array(data['distances'], dtype=np.float64),
+                np.array(data['durations'], dtype=np.float64))
+
+    def _key(self, profile, origin, destination):
+        return f'{profile}|{origin[0]:.6f},{origin[1]:.6f}|{destination[0]:.6f},{destination[1]:.6f}'
+
+
+class _BlockMatrix(object):
+    '''
+    Util sparse matrix used by nearest to store only the routed origin, destination pairs.
+    '''
+
+    def __init__(self, values):
+        self.values = values
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+
+def _lonlat(points):
+    '''
+    Util function to get a (n, 2) lon, lat array from a point GeoDataFrame or an array.
+    '''
+
+    if hasattr(points, 'geometry'):
+        return np.column_stack([points.geometry.x.values, points.geometry.y.values])
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
@@ -0,0 +1,439 @@
+'''
+Local HTTP service returning hexagon indicators for a district or polygon.
+
+Population hexagons, facility indexes and district boundaries are loaded once, and the
+2SFCA access score of every facility set is computed once over the full grid of every
+resolution, so the facility demand includes the people outside the requested area.
+Every request polyfills the area at the requested resolution, looks up the population
+in a HexPyramid and the access scores, and searches the nearest facility. The CPU work
+runs in a process pool so the event loop keeps serving, computed responses are kept in
+an LRU cache and identical requests in flight are computed once.
+
+Endpoints
+---------
+
+    GET  /indicators?district=MIRAFLORES&resolution=9
+    POST /indicators   {"polygon": <GeoJSON geometry>, "resolution": 8}
+    GET  /stats
+    GET  /health
+
+Responses are columnar JSON: {"resolution": 9, "hex": [...], "population_2020": [...],
+"dist_food_supply": [...], "access_food_supply": [...]}
+
+Usage
+-----
+
+    python -m hrud.service config.json --port 8080 --workers 2
+
+Config example
+--------------
+
+    {
+        "districts": "inputs/lima_distritos/lima_metropolitana.shp",
+        "name_column": "distrito",
+        "population": "outputs/lima_9.parquet",
+        "population_column": "population_2020",
+        "resolution": 9,
+        "resolutions": [7, 8],
+        "facilities": {"food_supply": "outputs/lima_markets.geojson"},
+        "radius": 1.0,
+        "cache_size": 256
+    }
+
+'''
+import sys
+import json
+import asyncio
+import hashlib
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from h3 import h3
+from .hrud import HRUD, _h3_to_int, _int_to_h3
+from .pyramid import HexPyramid
+from .facility_index import FacilityIndex
+from .accessibility import Accessibility
+
+# Datos precargados en cada proceso del pool
+_STATE = dict()
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class LRUCache(object):
+    '''
+    Least recently used cache of computed responses.
+
+    Parameters
+    ----------
+
+    maxsize: int
+             Maximum number of responses kept
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+class HexService(object):
+    '''
+    Hexagon indicator service over preloaded data.
+
+    Parameters
+    ----------
+
+    districts: GeoDataFrame
+               District polygons in EPSG 4326 that can be requested by name
+
+    population: GeoDataFrame or DataFrame
+                Population hexagons at the finest resolution (e.g. from merge_shape_hex or
+                export_hex), with the H3 indexes in hex_col
+
+    resolution: int
+                Resolution of the population hexagons
+
+    population_column: str
+                       Column of population with the demand of the 2SFCA access score
+
+    resolutions: list, optional
+                 Coarser resolutions served, rolled up from the population hexagons
+
+    facilities: dict, optional
+                Facility set name as keys and point GeoDataFrames in EPSG 4326 as values
+
+    name_column: column of districts with the names used in requests
+
+    hex_col: column name in population containing the H3 indexes
+
+    radius: float
+            Catchment radius in km of the 2SFCA access score
+
+    cache_size: int
+                Number of responses kept in the LRU cache
+
+    workers: int
+             Number of worker processes for the indicator computation
+
+    Example
+    -------
+
+    >> service = HexService(lima_districts, lima_hex_pop, 9, 'population_2020', resolutions=[7, 8],
+                            facilities={'food_supply': markets}, name_column='distrito')
+    >> asyncio.run(service.serve(port=8080))
+
+    '''
+
+    def __init__(self, districts, population, resolution, population_column='population_2020', resolutions=None,
+                 facilities=None, name_column='name', hex_col=0, radius=1.0, cache_size=256, workers=1):
+        if population_column not in population.columns:
+            raise ValueError(f'population_column {population_column} is not a column of population')
+
+        columns = [column for column in population.columns if column not in (hex_col, 'geometry')]
+        pyramid = HexPyramid.from_hex(population, resolution, resolutions or [], sums=columns, hex_col=hex_col)
+        facilities = {name: (gdf.geometry.y.values, gdf.geometry.x.values) for name, gdf in (facilities or {}).items()}
+
+        names = districts[name_column].astype(str).str.upper().values
+        state = {
+            'levels': pyramid.levels,
+            'districts': dict(zip(names, shapely.to_wkb(np.asarray(districts.geometry.values)))),
+            'facilities': facilities,
+            'access': _grid_access(pyramid.levels, population_column, facilities, radius),
+        }
+
+        self.resolutions = sorted(pyramid.levels)
+        self.districts = set(names)
+        self.cache = LRUCache(cache_size)
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,))
+        self.in_flight = dict()
+        self.requests = 0
+        self.coalesced = 0
+
+    async def query(self, params):
+        '''
+        Indicators for a request as JSON bytes, from the cache or computed in the pool.
+
+        Parameters
+        ----------
+
+        params: dict
+                'district' name or 'polygon' GeoJSON geometry, and 'resolution'
+
+        Returns
+        -------
+
+        status: int
+        body: bytes
+        '''
+
+        try:
+            key, task = self._parse(params)
+        except ValueError as err:
+            return 400, _json({'error': str(err)})
+        except KeyError as err:
+            return 404, _json({'error': f'Unknown district {err.args[0]}'})
+
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+
+        # Peticiones iguales en curso esperan el mismo resultado
+        if key in self.in_flight:
+            self.coalesced += 1
+            try:
+                return 200, await asyncio.shield(self.in_flight[key])
+            except Exception as err:
+                return 500, _json({'error': repr(err)})
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, _compute, task)
+        self.in_flight[key] = future
+        try:
+            body = await future
+        except Exception as err:
+            return 500, _json({'error': repr(err)})
+        finally:
+            del self.in_flight[key]
+
+        self.cache.put(key, body)
+        return 200, body
+
+    def stats(self):
+        '''
+        Request and cache counters.
+        '''
+
+        return {'requests': self.requests, 'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses,
+                'cache_size': len(self.cache.items), 'coalesced': self.coalesced, 'in_flight': len(self.in_flight)}
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        '''
+        Serve the HTTP endpoints until cancelled.
+        '''
+
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _parse(self, params):
+        '''
+        Validate a request and return its cache key and worker task.
+        '''
+
+        try:
+            resolution = int(params.get('resolution', self.resolutions[-1]))
+        except (TypeError, ValueError):
+            raise ValueError('resolution must be an integer')
+        if resolution not in self.resolutions:
+            raise ValueError(f'resolution must be one of {self.resolutions}')
+
+        if params.get('district') is not None:
+            district = str(params['district']).upper()
+            if district not in self.districts:
+                raise KeyError(district)
+            return ('district', district, resolution), {'district': district, 'resolution': resolution}
+
+        if params.get('polygon') is not None:
+            try:
+                polygon = shapely.normalize(shapely.geometry.shape(params['polygon']))
+            except Exception:
+                raise ValueError('polygon must be a GeoJSON geometry')
+            if polygon.geom_type not in ('Polygon', 'MultiPolygon'):
+                raise ValueError('polygon must be a Polygon or MultiPolygon')
+            wkb = shapely.to_wkb(polygon)
+            return ('polygon', hashlib.sha1(wkb).hexdigest(), resolution), {'polygon': wkb, 'resolution': resolution}
+
+        raise ValueError('district or polygon is required')
+
+    async def _handle(self, reader, writer):
+        '''
+        HTTP/1.1 connection handler with keep-alive.
+        '''
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                method, target = request_line.decode('latin-1').split()[:2]
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                self.requests += 1
+                status, payload = await self._route(method, target, body)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+
+        if url.path == '/health':
+            return 200, _json({'status': 'ok'})
+        if url.path == '/stats':
+            return 200, _json(self.stats())
+        if url.path != '/indicators':
+            return 404, _json({'error': f'Unknown path {url.path}'})
+
+        if method == 'GET':
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        elif method == 'POST':
+            try:
+                params = json.loads(body or b'{}')
+            except ValueError:
+                return 400, _json({'error': 'Invalid JSON body'})
+            if not isinstance(params, dict):
+                return 400, _json({'error': 'The JSON body must be an object'})
+        else:
+            return 405, _json({'error': f'Method {method} not allowed'})
+
+        return await self.query(params)
+
+
+def _init_worker(state):
+    '''
+    Util function to keep the preloaded data in every worker process.
+    '''
+
+    _STATE.clear()
+    _STATE.update(state)
+    _STATE['hrud'] = HRUD()
+    _STATE['indexes'] = {name: FacilityIndex(lat, lon) for name, (lat, lon) in state['facilities'].items()}
+
+
+def _compute(task):
+    '''
+    Util function computing the indicators of a request in a worker process.
+    '''
+
+    resolution = task['resolution']
+    wkb = _STATE['districts'][task['district']] if 'district' in task else task['polygon']
+    area = gpd.GeoDataFrame(geometry=[shapely.from_wkb(wkb)], crs='EPSG:4326')
+
+    h3_indexes = _STATE['hrud']._polyfill_city(resolution, area, 1)
+    cells = _h3_to_int(h3_indexes)
+    level = _STATE['levels'][resolution].reindex(cells)
+
+    response = {'resolution': resolution, 'hex': list(h3_indexes)}
+    for column in level.columns:
+        response[column] = level[column].values
+
+    centroids = np.array([h3.h3_to_geo(hexagon) for hexagon in h3_indexes]).reshape(-1, 2)
+
+    for name, index in _STATE['indexes'].items():
+        if len(cells) == 0:
+            response[f'dist_{name}'] = response[f'access_{name}'] = []
+            continue
+        response[f'dist_{name}'] = index.query(centroids[:, 0], centroids[:, 1])[0][:, 0]
+        response[f'access_{name}'] = _STATE['access'][name][resolution].reindex(cells).values
+
+    for key, values in response.items():
+        if isinstance(values, np.ndarray):
+            response[key] = [None if np.isnan(value) else float(f'{value:.6g}')
+                             for value in values.astype(np.float64).tolist()]
+
+    return _json(response)
+
+
+def _grid_access(levels, population_column, facilities, radius):
+    '''
+    Util function to compute the 2SFCA access score of every facility set over the full
+    grid of every resolution.
+    '''
+
+    access = dict()
+    for name, (lat, lon) in facilities.items():
+        index = FacilityIndex(lat, lon)
+        access[name] = dict()
+        for resolution, level in levels.items():
+            centroids = np.array([h3.h3_to_geo(hexagon) for hexagon in _int_to_h3(level.index.values)]).reshape(-1, 2)
+            scores = Accessibility.from_index(index, centroids[:, 0], centroids[:, 1], radius=radius) \
+                .two_step_fca(level[population_column].fillna(0).values)[0]
+            access[name][resolution] = pd.Series(scores, index=level.index)
+
+    return access
+
+
+def _json(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve hexagon indicators over HTTP')
+    parser.add_argument('config', help='JSON config file with districts, population and facilities')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    districts = gpd.read_file(config['districts']).to_crs('EPSG:4326')
+    population = pd.read_parquet(config['population'])
+    facilities = {name: gpd.read_file(path).to_crs('EPSG:4326')
+                  for name, path in config.get('facilities', {}).items()}
+
+    service = HexService(districts, population, config['resolution'], config.get('population_column', 'population_2020'),
+                         resolutions=config.get('resolutions'),
+                         facilities=facilities, name_column=config.get('name_column', 'name'),
+                         hex_col=config.get('hex_col', 'hex'), radius=config.get('radius', 1.0),
+                         cache_size=config.get('cache_size', 256), workers=args.workers)
+
+    print(f'Serving on http://{args.host}:{args.port}', file=sys.stderr)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from hrud import FacilityLocation
+
+
+def test_max_coverage_radius_larger_than_max_cost():
+    costs = sparse.csc_matrix(np.array([[0.1, 0.0], [0.25, 0.2], [0.0, 0.3]]))
+    flp = FacilityLocation(costs, [1, 2, 3], max_cost=0.3)
+
+    with pytest.raises(ValueError, match='max_cost'):
+        flp.max_coverage(1, radius=5.0)
+
+    sites, _ = flp.max_coverage(1, radius=0.3)
+    assert list(sites['site']) == [1]
+    assert sites['covered'].iloc[-1] == 5
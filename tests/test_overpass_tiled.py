@@ -0,0 +1,94 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pytest
+from hrud import HRUD
+
+BOUNDS = (-77.2, -12.5, -76.6, -11.6)
+FAILING = (-77.0, -12.05, -76.8, -11.6)
+
+
+def square(x, y, size=0.001):
+    coords = [(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]
+    return [{'lon': lon, 'lat': lat} for lon, lat in coords]
+
+
+class OverpassHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in Overpass server. Every tile returns a node of its own plus node 1 and way 1,
+    which share their id across id spaces and are returned by every tile. Way 2 is
+    returned by the two western tiles. The first request of the FAILING tile gets a 503.
+    '''
+
+    def do_GET(self):
+        server = self.server
+        tile = tuple(round(float(value), 6) for value in parse_qs(urlsplit(self.path).query)['bbox'][0].split(','))
+        with server.lock:
+            server.requests[tile] += 1
+            fail = tile == FAILING and server.requests[tile] == 1
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        minx, miny = tile[:2]
+        elements = [
+            {'type': 'node', 'id': 1000 + int(minx * 10) * 100 + int(miny * 100) % 100, 'lat': miny, 'lon': minx,
+             'tags': {'leisure': 'pitch'}},
+            {'type': 'node', 'id': 1, 'lat': -12.0, 'lon': -77.0, 'tags': {'leisure': 'pitch'}},
+            {'type': 'way', 'id': 1, 'nodes': [1, 2, 3, 4, 1], 'tags': {'leisure': 'park'},
+             'geometry': square(-77.0, -12.0)},
+        ]
+        if minx == BOUNDS[0]:
+            elements.append({'type': 'way', 'id': 2, 'nodes': [5, 6, 7, 8, 5], 'tags': {'leisure': 'pitch'},
+                             'geometry': square(-77.1, -12.1)})
+
+        body = json.dumps({'elements': elements}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def overpass():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OverpassHandler)
+    server.lock = threading.Lock()
+    server.requests = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_tiled_download_retries_and_dedupes(overpass):
+    hrud = HRUD()
+    hrud.overpass_url = f'http://127.0.0.1:{overpass.server_address[1]}/api/interpreter'
+    nodes, ways = hrud.download_overpass_poi_tiled(BOUNDS, 'parks_pitches', n_tiles=(3, 2), max_workers=3,
+                                                   retries=2, backoff=0)
+
+    # 3 x 2 tiles covering the bounds
+    tiles = np.array(sorted(overpass.requests))
+    assert len(tiles) == 6
+    assert sorted(set(tiles[:, 0])) == [-77.2, -77.0, -76.8]
+    assert sorted(set(tiles[:, 1])) == [-12.5, -12.05]
+    np.testing.assert_allclose(tiles[:, 2] - tiles[:, 0], 0.2)
+    np.testing.assert_allclose(tiles[:, 3] - tiles[:, 1], 0.45)
+
+    # Only the failing tile is requested again
+    assert overpass.requests[FAILING] == 2
+    assert sum(overpass.requests.values()) == 7
+
+    # Elements returned by several tiles are kept once, nodes and ways in their own id spaces
+    assert len(nodes) == 7
+    assert nodes['id'].is_unique and 1 in set(nodes['id'])
+    assert sorted(ways['id']) == [1, 2]
+    assert not ways.geometry.is_empty.any()
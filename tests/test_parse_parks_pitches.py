@@ -0,0 +1,27 @@
+import shapely
+from hrud import HRUD
+
+
+def way(id, coords):
+    return {'type': 'way', 'id': id, 'bounds': None, 'nodes': list(range(len(coords))), 'tags': {'leisure': 'park'},
+            'geometry': [{'lon': lon, 'lat': lat} for lon, lat in coords]}
+
+
+def test_mixed_short_and_valid_ways():
+    square = [(-77.0, -12.0), (-76.99, -12.0), (-76.99, -11.99), (-77.0, -11.99), (-77.0, -12.0)]
+    elements = [
+        way(1, square[:2]),                              # 2 vertices
+        way(2, square),
+        way(3, [square[0], square[1], square[0]]),       # closed ring with 2 distinct vertices
+        way(4, square[:3]),                              # open triangle
+        way(5, []),
+        {'type': 'node', 'id': 6, 'lat': -12.0, 'lon': -77.0, 'tags': None},
+    ]
+
+    nodes, ways = HRUD()._parse_parks_pitches(elements)
+
+    assert list(ways['id']) == [1, 2, 3, 4, 5]
+    assert list(shapely.is_empty(ways.geometry.values.data)) == [True, False, True, False, True]
+    assert ways.geometry.iloc[1].equals(shapely.Polygon(square))
+    assert ways.geometry.iloc[3].equals(shapely.Polygon(square[:3]))
+    assert len(nodes) == 1
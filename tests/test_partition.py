@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from hrud import HRUD
+from hrud.partition import run_partitioned
+
+
+def test_partitioned_population_matches_in_memory(tmp_path):
+    districts = gpd.read_file('inputs/lima_distritos/lima_metropolitana.shp').to_crs('EPSG:4326')
+    area = districts[districts['distrito'].isin(['MIRAFLORES', 'SAN ISIDRO', 'LINCE', 'SURQUILLO'])]
+
+    # Points around the area bounds, so some fall outside the area and its shards
+    rng = np.random.default_rng(0)
+    minx, miny, maxx, maxy = area.total_bounds
+    n = 200000
+    pop = pd.DataFrame({'latitude': rng.uniform(miny - 0.05, maxy + 0.05, n),
+                        'longitude': rng.uniform(minx - 0.05, maxx + 0.05, n),
+                        'population_2020': rng.gamma(2, 2, n)})
+    csv = tmp_path / 'population.csv'
+    pop.to_csv(csv, index=False)
+
+    hrud = HRUD()
+    points = hrud.filter_population(pd.read_csv(csv), area)
+    hexagons, _ = hrud.gen_hexagons(9, area)
+    expected = hrud.merge_shape_hex(hexagons, points, 'inner', 'within', {'population_2020': 'sum'}, method='h3')
+    expected = expected.set_index(0)['population_2020'].dropna()
+
+    summary = run_partitioned(area, str(csv), str(tmp_path / 'out'), resolution=9, shard_resolution=6,
+                              chunksize=50000)
+    result = pd.read_parquet(tmp_path / 'out').set_index('hex')['population_2020'].dropna()
+
+    assert len(summary) > 1
+    assert set(result.index) == set(expected.index)
+    np.testing.assert_allclose(result.loc[expected.index].values, expected.values, rtol=1e-5)
+    np.testing.assert_allclose(result.sum(), expected.sum(), rtol=1e-6)
@@ -0,0 +1,113 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import geopandas as gpd
+import pytest
+from hrud import OSRMClient
+
+SPEEDS = {'walking': 1.4, 'driving': 8.0}
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000.0 * np.arcsin(np.sqrt(a))
+
+
+class TableHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in OSRM /table server: distances are haversine meters and durations use a
+    constant speed per profile. The first request gets a 503.
+    '''
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        _, _, _, profile, coords = url.path.split('/', 4)
+        query = parse_qs(url.query)
+        coords = np.array([[float(value) for value in pair.split(',')] for pair in coords.split(';')])
+        sources = [int(i) for i in query['sources'][0].split(';')]
+        targets = [int(i) for i in query['destinations'][0].split(';')]
+
+        with server.lock:
+            server.calls += 1
+            fail = server.calls == 1
+            if not fail:
+                server.requests.append((profile, len(coords), len(sources), len(targets)))
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        origins, destinations = coords[sources], coords[targets]
+        distances = haversine_m(origins[:, None, 0], origins[:, None, 1], destinations[None, :, 0],
+                                destinations[None, :, 1])
+        body = json.dumps({'code': 'Ok', 'distances': distances.tolist(),
+                           'durations': (distances / SPEEDS[profile]).tolist()}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def osrm():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TableHandler)
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.requests = list()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def points(n, seed):
+    rng = np.random.default_rng(seed)
+    return np.round(np.column_stack([rng.uniform(-77.05, -76.95, n), rng.uniform(-12.1, -12.0, n)]), 6)
+
+
+def test_table_chunks_retries_and_caches(osrm):
+    client = OSRMClient(f'http://127.0.0.1:{osrm.server_address[1]}', max_table_size=6, max_workers=3, backoff=0)
+    origins, destinations = points(7, 0), points(9, 1)
+
+    distances, durations = client.table(origins, destinations)
+
+    # 7 x 9 pairs in 3 x 3 blocks of at most 3 origins and 3 destinations, one retried request
+    assert osrm.calls == 10
+    assert len(osrm.requests) == 9
+    assert all(n_coords <= 6 for _, n_coords, _, _ in osrm.requests)
+    expected = haversine_m(origins[:, None, 0], origins[:, None, 1], destinations[None, :, 0], destinations[None, :, 1])
+    np.testing.assert_allclose(distances, expected)
+    np.testing.assert_allclose(durations, expected / SPEEDS['walking'])
+
+    # Cached by origin, destination and profile
+    client.table(origins[2:5], destinations[::2])
+    assert len(osrm.requests) == 9
+    _, driving = client.table(origins, destinations, profile='driving')
+    assert len(osrm.requests) == 18
+    assert {profile for profile, _, _, _ in osrm.requests[9:]} == {'driving'}
+    np.testing.assert_allclose(driving, expected / SPEEDS['driving'])
+
+
+def test_nearest_aligned_with_centroids(osrm):
+    client = OSRMClient(f'http://127.0.0.1:{osrm.server_address[1]}', max_table_size=10, backoff=0)
+    origins, destinations = points(25, 2), points(12, 3)
+    centroids = gpd.GeoDataFrame(index=np.arange(100, 125)[::-1],
+                                 geometry=gpd.points_from_xy(origins[:, 0], origins[:, 1]), crs='EPSG:4326')
+
+    nearest = client.nearest(centroids, destinations, k=3)
+
+    durations = haversine_m(origins[:, None, 0], origins[:, None, 1], destinations[None, :, 0],
+                            destinations[None, :, 1]) / SPEEDS['walking']
+    assert list(nearest.index) == list(centroids.index)
+    assert list(nearest['facility']) == list(durations.argmin(axis=1))
+    np.testing.assert_allclose(nearest['duration'].values, durations.min(axis=1))
+    assert all(n_coords <= 10 for _, n_coords, _, _ in osrm.requests)